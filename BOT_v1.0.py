@@ -1,11 +1,77 @@
 ﻿import json
-import requests
+import os
+import sys
+import math
+import time
+import asyncio
+import random
+from array import array
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlsplit
+import httpx
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, ConversationHandler, filters
 
 # Файл для хранения данных пользователей
 DATA_FILE = "user_data.json"
 
+# Кэш погоды: время жизни по источникам (секунды) и ограничение памяти
+WEATHER_TTL = {"open-meteo": 1800}
+WEATHER_CACHE_BYTES = 4 * 1024 * 1024
+
+weather_cache = OrderedDict()  # (источник, город) -> (истекает, размер, данные)
+weather_cache_bytes = 0
+inflight_fetches = {}  # (источник, город) -> задача, которая сейчас загружает данные
+
+# Прогноз Open-Meteo: на сколько дней запрашивать и какие переменные по дням и по часам
+FORECAST_DAYS = 16
+DAILY_VARIABLES = ("temperature_2m_max", "temperature_2m_min", "precipitation_sum", "weathercode")
+HOURLY_VARIABLES = ("temperature_2m", "precipitation", "weathercode")
+
+# Виды прогноза для /weather <вид>: (по дням или по часам, с какого дня/часа, сколько, шаг)
+FORECAST_MODES = {
+    "tomorrow": ("daily", 1, 1, 1),
+    "завтра": ("daily", 1, 1, 1),
+    "hourly": ("hourly", 0, 24, 3),
+    "часы": ("hourly", 0, 24, 3),
+    "week": ("daily", 0, 7, 1),
+    "неделя": ("daily", 0, 7, 1),
+}
+
+# Словарь для расшифровки погодного кода
+WEATHER_CODE_MAP = {
+    0: "Ясно ☀️",
+    1: "Преимущественно ясно 🌤️",
+    2: "Переменная облачность ⛅",
+    3: "Пасмурно ☁️",
+    45: "Туман 🌫️",
+    48: "Туман с изморозью 🌫️❄️",
+    51: "Слабая морось 🌦️",
+    61: "Слабой интенсивности дождь 🌧️",
+    71: "Слабой интенсивности снегопад 🌨️",
+    80: "Грозы 🌩️",
+}
+
+# Файл с координатами уже найденных городов и минимальный интервал между запросами к Nominatim
+GEOCODE_FILE = "geocode_index.json"
+NOMINATIM_INTERVAL = 1.0
+
+geocode_index = {}  # нормализованный город -> [широта, долгота]
+
+# HTTP-клиент: одновременных запросов на хост, наименьший интервал между запросами к хосту
+# (он же — наименьшая задержка перед повтором), число повторов и базовая задержка между ними
+HOST_CONCURRENCY = {"nominatim.openstreetmap.org": 1, "api.open-meteo.com": 10}
+HOST_MIN_INTERVAL = {"nominatim.openstreetmap.org": NOMINATIM_INTERVAL}
+DEFAULT_HOST_CONCURRENCY = 5
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+
+http_client = None  # общий клиент с пулом keep-alive соединений
+host_limits = {}  # хост -> семафор одновременных запросов
+nominatim_lock = asyncio.Lock()
+last_nominatim_call = 0.0
+
 # Функции для работы с JSON
 def load_data():
     try:
@@ -18,6 +84,242 @@ def save_data(data):
     with open(DATA_FILE, "w") as file:
         json.dump(data, file, ensure_ascii=False, indent=4)
 
+# Функции для кэширования погоды
+def normalize_city(city):
+    # Ключ кэша не зависит от регистра, лишних пробелов и различия ё/е
+    return " ".join(city.casefold().replace("ё", "е").split())
+
+def sizeof(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(sizeof(item) for item in value)
+    return size
+
+def cache_drop(key):
+    global weather_cache_bytes
+    _, size, _ = weather_cache.pop(key)
+    weather_cache_bytes -= size
+
+def cache_get(key):
+    entry = weather_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] < time.monotonic():
+        cache_drop(key)
+        return None
+    weather_cache.move_to_end(key)
+    return entry[2]
+
+def cache_put(key, value):
+    global weather_cache_bytes
+    if key in weather_cache:
+        cache_drop(key)
+    size = sizeof(key) + sizeof(value)
+    weather_cache[key] = (time.monotonic() + WEATHER_TTL.get(key[0], 0), size, value)
+    weather_cache_bytes += size
+    # Вытесняем давно не использованные записи сверх лимита памяти
+    while weather_cache_bytes > WEATHER_CACHE_BYTES and len(weather_cache) > 1:
+        cache_drop(next(iter(weather_cache)))
+
+def finish_fetch(key, task):
+    inflight_fetches.pop(key, None)
+    if not task.cancelled() and task.exception() is None and task.result() is not None:
+        cache_put(key, task.result())
+
+async def cached_fetch(source, city, fetch):
+    key = (source, normalize_city(city))
+    value = cache_get(key)
+    if value is not None:
+        return value
+
+    # Одновременные запросы одного города ждут одну общую загрузку
+    task = inflight_fetches.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        inflight_fetches[key] = task
+        task.add_done_callback(lambda done: finish_fetch(key, done))
+    return await asyncio.shield(task)
+
+# Функции для HTTP-запросов
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=30),
+        )
+    return http_client
+
+async def close_http_client(application):
+    if http_client is not None:
+        await http_client.aclose()
+
+def is_retryable(err):
+    # Повторяем сетевые сбои, 429 и ошибки сервера; остальные 4xx сразу отдаём наверх
+    if isinstance(err, httpx.HTTPStatusError):
+        return err.response.status_code == 429 or err.response.status_code >= 500
+    return isinstance(err, httpx.TransportError)
+
+async def http_get_json(url, params=None, headers=None):
+    host = urlsplit(url).hostname
+    if host not in host_limits:
+        host_limits[host] = asyncio.Semaphore(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY))
+
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            async with host_limits[host]:
+                response = await get_http_client().get(url, params=params, headers=headers)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as err:
+            if attempt == HTTP_RETRIES or not is_retryable(err):
+                raise
+            # Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли пачкой,
+            # но не меньше допустимого интервала хоста (Nominatim — 1 запрос в секунду)
+            await asyncio.sleep(max(random.uniform(0, HTTP_BACKOFF * 2 ** attempt),
+                                    HOST_MIN_INTERVAL.get(host, 0)))
+
+# Функции для работы с индексом координат
+def load_geocode_index():
+    try:
+        with open(GEOCODE_FILE, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def save_geocode_index(index):
+    # Пишем во временный файл и подменяем, чтобы сбой не оставил обрезанный индекс
+    tmp_file = GEOCODE_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        json.dump(index, file, ensure_ascii=False)
+    os.replace(tmp_file, GEOCODE_FILE)
+
+def import_cities(path):
+    # Загрузка известных городов: JSON {"город": [широта, долгота]} или строки "город;широта;долгота"
+    index = load_geocode_index()
+    with open(path, "r", encoding="utf-8") as file:
+        if path.endswith(".json"):
+            rows = [(city, *coords) for city, coords in json.load(file).items()]
+        else:
+            rows = [line.strip().split(";") for line in file if line.strip()]
+    for city, lat, lon in rows:
+        index[normalize_city(city)] = [float(lat), float(lon)]
+    save_geocode_index(index)
+    return len(rows)
+
+async def geocode(city, headers):
+    global last_nominatim_call
+    key = normalize_city(city)
+    if key in geocode_index:
+        return geocode_index[key]
+
+    # Nominatim допускает не больше одного запроса в секунду
+    async with nominatim_lock:
+        if key in geocode_index:
+            return geocode_index[key]
+        delay = last_nominatim_call + NOMINATIM_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        geocode_url = "https://nominatim.openstreetmap.org/search"
+        try:
+            geocode_data = await http_get_json(
+                geocode_url, params={"city": city, "format": "json"}, headers=headers)
+        finally:
+            last_nominatim_call = time.monotonic()
+
+        if not geocode_data:
+            return None
+
+        geocode_index[key] = [float(geocode_data[0]["lat"]), float(geocode_data[0]["lon"])]
+        save_geocode_index(geocode_index)
+        return geocode_index[key]
+
+# Функции для хранения прогноза по столбцам
+def to_columns(block, variables):
+    # Каждая переменная — отдельный массив чисел (float32, коды погоды — int16) вместо списка объектов;
+    # пропуски хранятся как NaN и -1
+    columns = {"start": block["time"][0]}
+    for name in variables:
+        values = block.get(name) or []
+        if name == "weathercode":
+            columns[name] = array("h", (-1 if value is None else int(value) for value in values))
+        else:
+            columns[name] = array("f", (math.nan if value is None else value for value in values))
+    return columns
+
+def to_forecast(data):
+    # Компактный прогноз: смещение часового пояса и столбцы по дням и по часам
+    return {
+        "utc_offset": data.get("utc_offset_seconds", 0),
+        "daily": to_columns(data["daily"], DAILY_VARIABLES),
+        "hourly": to_columns(data["hourly"], HOURLY_VARIABLES),
+    }
+
+def local_now(forecast):
+    return datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=forecast["utc_offset"])
+
+def number(value):
+    return "—" if math.isnan(value) else f"{value:.1f}"
+
+def describe(code):
+    return WEATHER_CODE_MAP.get(code, "Неизвестные условия 🌈")
+
+def format_days(city, forecast, first, count):
+    # Срез по дням: first — смещение от сегодняшнего дня
+    daily = forecast["daily"]
+    start = date.fromisoformat(daily["start"])
+    today = (local_now(forecast).date() - start).days
+    days = range(max(today + first, 0), min(today + first + count, len(daily["temperature_2m_max"])))
+    if not days:
+        return None
+
+    if first == 1 and count == 1:
+        message = f"Погода в {city} на завтра:\n"
+    elif first == 0 and count == 3:
+        message = f"Погода в {city} на 3 дня:\n"
+    else:
+        message = f"Погода в {city} на {len(days)} дн.:\n"
+    for i, day in enumerate(days):
+        label = f"День {i+1}" if first == 0 else (start + timedelta(days=day)).strftime("%d.%m")
+        message += (
+            f"{label}:\n"
+            f"Температура: {number(daily['temperature_2m_min'][day])}°C - {number(daily['temperature_2m_max'][day])}°C\n"
+            f"Осадки: {number(daily['precipitation_sum'][day])} мм\n"
+            f"Условия: {describe(daily['weathercode'][day])}\n\n"
+        )
+    return message
+
+def format_hours(city, forecast, first, count, step):
+    # Срез по часам, начиная с текущего часа
+    hourly = forecast["hourly"]
+    start = datetime.fromisoformat(hourly["start"])
+    now = int((local_now(forecast) - start).total_seconds() // 3600)
+    hours = range(max(now + first, 0), min(now + first + count, len(hourly["temperature_2m"])), step)
+    if not hours:
+        return None
+
+    message = f"Погода в {city} по часам:\n"
+    for hour in hours:
+        moment = start + timedelta(hours=hour)
+        message += (
+            f"{moment:%H:%M}: {number(hourly['temperature_2m'][hour])}°C, "
+            f"осадки {number(hourly['precipitation'][hour])} мм, {describe(hourly['weathercode'][hour])}\n"
+        )
+    return message
+
+def forecast_mode(args):
+    # /weather, /weather tomorrow|hourly|week или /weather <число дней до 16>
+    if not args:
+        return ("daily", 0, 3, 1)
+    word = args[0].casefold()
+    if word in FORECAST_MODES:
+        return FORECAST_MODES[word]
+    if word.isdigit() and 1 <= int(word) <= FORECAST_DAYS:
+        return ("daily", 0, int(word), 1)
+    return None
+
 # Обработчики команд
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -94,80 +396,79 @@ async def weather(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Сначала используйте команду /start.")
         return ConversationHandler.END
 
+    # Вид прогноза запоминается до выбора города
+    mode = forecast_mode(context.args)
+    if mode is None:
+        await update.message.reply_text(
+            "Доступно: /weather, /weather tomorrow, /weather hourly, /weather week или /weather <1-16> (дней).")
+        return ConversationHandler.END
+    context.user_data["forecast_mode"] = mode
+
     cities = data[user_id]["cities"]
     keyboard = [[KeyboardButton(city)] for city in cities if city != "null"]
     reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
     await update.message.reply_text("Выберите город:", reply_markup=reply_markup)
     return 1
 
+async def load_forecast(city):
+    # Получение координат города (из индекса или через Nominatim)
+    headers = {
+        "User-Agent": "WeatherBot/1.0 (your_email@example.com)"
+    }
+    coords = await geocode(city, headers)
+
+    if coords is None:
+        return None
+
+    lat, lon = coords
+
+    # Получение данных о погоде: один запрос на все дни и часы, дальше срезы из кэша
+    weather_url = "https://api.open-meteo.com/v1/forecast"
+    params = {
+        "latitude": lat,
+        "longitude": lon,
+        "daily": ",".join(DAILY_VARIABLES),
+        "hourly": ",".join(HOURLY_VARIABLES),
+        "forecast_days": FORECAST_DAYS,
+        "timezone": "auto",
+    }
+    weather_data = await http_get_json(weather_url, params=params)
+
+    # Проверка данных
+    if "daily" not in weather_data or "hourly" not in weather_data or not weather_data["daily"].get("time"):
+        raise ValueError("в ответе нет прогноза")
+    return to_forecast(weather_data)
+
 async def fetch_weather(update: Update, context: ContextTypes.DEFAULT_TYPE):
     city = update.message.text
+    kind, first, count, step = context.user_data.pop("forecast_mode", ("daily", 0, 3, 1))
     try:
-        # Получение координат города
-        headers = {
-            "User-Agent": "WeatherBot/1.0 (your_email@example.com)"
-        }
-        geocode_url = f"https://nominatim.openstreetmap.org/search?city={city}&format=json"
-        response = requests.get(geocode_url, headers=headers, timeout=10)
-        response.raise_for_status()
-        geocode_data = response.json()
+        forecast = await cached_fetch("open-meteo", city, lambda: load_forecast(city))
 
-        if not geocode_data:
+        if forecast is None:
             await update.message.reply_text("Город не найден. Попробуйте другой.")
             return ConversationHandler.END
 
-        lat, lon = geocode_data[0]["lat"], geocode_data[0]["lon"]
-
-        # Получение данных о погоде
-        weather_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=temperature_2m_max,temperature_2m_min,precipitation_sum,weathercode&timezone=auto"
-        weather_response = requests.get(weather_url, timeout=10)
-        weather_response.raise_for_status()
-        weather_data = weather_response.json()
+        # Формирование сообщения с погодой из нужного среза
+        if kind == "hourly":
+            weather_message = format_hours(city, forecast, first, count, step)
+        else:
+            weather_message = format_days(city, forecast, first, count)
 
-        # Проверка данных
-        if "daily" not in weather_data or not weather_data["daily"].get("temperature_2m_min") or not weather_data["daily"].get("temperature_2m_max"):
+        if weather_message is None:
             await update.message.reply_text("Не удалось получить данные о погоде для данного города.")
             return ConversationHandler.END
 
-        daily = weather_data["daily"]
-
-        # Словарь для расшифровки погодного кода
-        weather_code_map = {
-            0: "Ясно ☀️",
-            1: "Преимущественно ясно 🌤️",
-            2: "Переменная облачность ⛅",
-            3: "Пасмурно ☁️",
-            45: "Туман 🌫️",
-            48: "Туман с изморозью 🌫️❄️",
-            51: "Слабая морось 🌦️",
-            61: "Слабой интенсивности дождь 🌧️",
-            71: "Слабой интенсивности снегопад 🌨️",
-            80: "Грозы 🌩️",
-        }
-
-        # Формирование сообщения с погодой
-        weather_message = f"Погода в {city} на 3 дня:\n"
-        for i in range(3):
-            temp_min = daily['temperature_2m_min'][i]
-            temp_max = daily['temperature_2m_max'][i]
-            precipitation = daily.get('precipitation_sum', [0])[i]  # Осадки
-            weather_code = daily.get('weathercode', [0])[i]  # Код погоды
-            weather_description = weather_code_map.get(weather_code, "Неизвестные условия 🌈")
-
-            weather_message += (
-                f"День {i+1}:\n"
-                f"Температура: {temp_min}°C - {temp_max}°C\n"
-                f"Осадки: {precipitation} мм\n"
-                f"Условия: {weather_description}\n\n"
-            )
-
         await update.message.reply_text(weather_message)
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         await update.message.reply_text(f"HTTP ошибка: {http_err}")
         print(f"HTTP ошибка: {http_err}")
-    except requests.exceptions.RequestException as req_err:
+    except httpx.RequestError as req_err:
         await update.message.reply_text("Ошибка сети. Попробуйте ещё раз позже.")
         print(f"Ошибка сети: {req_err}")
+    except ValueError as data_err:
+        await update.message.reply_text("Не удалось получить данные о погоде для данного города.")
+        print(f"Ошибка данных: {data_err}")
     except IndexError as index_err:
         await update.message.reply_text("Ошибка данных. Проверьте название города.")
         print(f"Ошибка данных: {index_err}")
@@ -179,7 +480,8 @@ async def fetch_weather(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Основная функция
 def main():
-    application = Application.builder().token("*").build()
+    geocode_index.update(load_geocode_index())
+    application = Application.builder().token("*").post_shutdown(close_http_client).build()
 
     settings_handler = ConversationHandler(
         entry_points=[CommandHandler("settings", settings)],
@@ -193,7 +495,8 @@ def main():
     weather_handler = ConversationHandler(
         entry_points=[CommandHandler("weather", weather)],
         states={
-            1: [MessageHandler(filters.TEXT & ~filters.COMMAND, fetch_weather)],
+            # Запросы погоды разных пользователей выполняются параллельно
+            1: [MessageHandler(filters.TEXT & ~filters.COMMAND, fetch_weather, block=False)],
         },
         fallbacks=[]
     )
@@ -205,4 +508,8 @@ def main():
     application.run_polling()
 
 if __name__ == "__main__":
-    main()
+    # python BOT_v1.0.py --import-cities cities.csv — заполнить индекс координат заранее
+    if len(sys.argv) == 3 and sys.argv[1] == "--import-cities":
+        print(f"Импортировано городов: {import_cities(sys.argv[2])}")
+    else:
+        main()
@@ -0,0 +1,415 @@
+"""
+Нагрузочный тест бота без Telegram и сайтов погоды.
+Поднимает локальную заглушку (Bot API, страницы Яндекса, Nominatim, Open-Meteo),
+прогоняет N пользователей через диалоги /start, /settings и /weather
+и выводит число запросов в секунду, задержки p50/p95/p99 и пик памяти.
+
+Пример: python benchmark.py --users 200 --concurrency 50 --providers open-meteo
+С --mode webhook обновления приходят POST-запросами на вебхук бота, как от Telegram.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+import httpx
+from telegram import Update
+try:
+    import resource
+except ImportError:
+    # Windows: пик памяти берётся из psutil
+    resource = None
+
+ROOT = Path(__file__).resolve().parent
+FIXTURES = ROOT / "fixtures"
+BOT_FILE = ROOT / "ВОТ_v1.2.py"
+TOKEN = "123456:BENCHMARK"
+WEBHOOK_SECRET = "benchmark-secret"
+CITIES = ["Москва", "Тула", "Омск", "Казань", "Самара", "Пермь", "Уфа", "Томск"]
+
+
+def load_bot():
+    """
+    Импортирует модуль бота из файла
+    """
+    spec = importlib.util.spec_from_file_location("weather_bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, share):
+    """
+    Перцентиль отсортированного списка
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(share * (len(values) - 1))))
+    return values[index]
+
+
+def busy_time(spans):
+    """
+    Сколько секунд хотя бы один запрос ждал ответа бота: длина объединения
+    отрезков (начало, конец) без пауз между шагами пользователей
+    """
+    total = 0.0
+    end = None
+    for start, finish in sorted(spans):
+        if end is None or start > end:
+            total += finish - start
+            end = finish
+        elif finish > end:
+            total += finish - end
+            end = finish
+    return total
+
+
+def peak_memory():
+    """
+    Пик резидентной памяти процесса, МБ, или None, если его не узнать
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss в Linux — килобайты, в macOS — байты
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss) / (1024 * 1024)
+
+
+class StubServer:
+    """
+    Локальный HTTP-сервер, отвечающий сохранёнными страницами и JSON
+    вместо Яндекса, Nominatim и Open-Meteo, а также заглушка Bot API,
+    которая запоминает ответы бота по чатам
+    """
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.replies = {}
+        self.requests = 0
+        self._message_id = 0
+        self._server = None
+        self.port = None
+        self.search_page = (FIXTURES / "yandex_search.html").read_bytes()
+        self.forecast_page = (FIXTURES / "yandex_forecast.html").read_bytes()
+        self.nominatim = (FIXTURES / "nominatim.json").read_bytes()
+        self.open_meteo = json.loads((FIXTURES / "open_meteo.json").read_text(encoding="utf-8"))
+
+    def inbox(self, chat_id):
+        """
+        Очередь ответов бота в чат
+        """
+        return self.replies.setdefault(chat_id, asyncio.Queue())
+
+    async def start(self):
+        """
+        Запускает сервер на свободном порту
+        """
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Останавливает сервер
+        """
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                target = request.decode().split()[1]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, content_type, payload = await self.route(target, headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, target, headers, body):
+        """
+        Выбирает ответ по адресу запроса
+        """
+        self.requests += 1
+        url = urlsplit(target)
+        if url.path.startswith("/bot"):
+            return self.bot_api(url.path.rsplit("/", 1)[-1], headers, body)
+
+        await asyncio.sleep(self.delay)
+        if url.path == "/pogoda/search":
+            return "200 OK", "text/html; charset=utf-8", self.search_page
+        if url.path == "/pogoda/":
+            return "200 OK", "text/html; charset=utf-8", self.forecast_page
+        if url.path == "/nominatim/search":
+            return "200 OK", "application/json", self.nominatim
+        if url.path == "/v1/forecast":
+            # На несколько координат Open-Meteo отвечает списком
+            count = parse_qs(url.query).get("latitude", [""])[0].count(",") + 1
+            data = self.open_meteo if count == 1 else [self.open_meteo] * count
+            return "200 OK", "application/json", json.dumps(data).encode()
+        return "404 Not Found", "text/plain", b"Not Found"
+
+    def bot_api(self, method, headers, body):
+        """
+        Заглушка Bot API: getMe и sendMessage
+        """
+        if "json" in headers.get("content-type", ""):
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+            self.inbox(chat_id).put_nowait(result["text"])
+        else:
+            result = True
+        return "200 OK", "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeUsers:
+    """
+    Генератор обновлений Telegram от имени пользователей
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_id = 0
+
+    def payload(self, user_id, text):
+        """
+        JSON обновления с текстовым сообщением или командой от пользователя
+        """
+        self._update_id += 1
+        message = {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self._update_id, "message": message}
+
+    def update(self, user_id, text):
+        """
+        То же обновление в виде объекта Update
+        """
+        return Update.de_json(self.payload(user_id, text), self.bot)
+
+
+class FakeTelegram:
+    """
+    Доставка обновлений на вебхук бота POST-запросами, как это делает Telegram
+    """
+    def __init__(self, url, secret):
+        self.url = url
+        self.client = httpx.AsyncClient(
+            headers={"X-Telegram-Bot-Api-Secret-Token": secret},
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+        )
+
+    async def post(self, payload):
+        """
+        Отправляет обновление и проверяет, что вебхук его принял
+        """
+        response = await self.client.post(self.url, json=payload)
+        response.raise_for_status()
+
+    async def close(self):
+        """
+        Закрывает соединения
+        """
+        await self.client.aclose()
+
+
+async def run_user(deliver, stub, user_id, latencies, spans, args):
+    """
+    Проводит одного пользователя через регистрацию, настройку города и запрос погоды.
+    Обновления передаёт deliver(user_id, text).
+    Задержка шага — от отправки обновления до ответа бота в чат,
+    сами отрезки ожидания собираются в spans.
+    Между шагами пользователь «думает» think_time секунд: неблокирующий обработчик
+    должен успеть вернуть новое состояние диалога, иначе ConversationHandler
+    пропустит следующее сообщение
+    """
+    city = CITIES[user_id % len(CITIES)]
+    steps = [
+        ("start", "/start"),
+        ("settings", "/settings"),
+        ("set_city", "null"),
+        ("save_city", city),
+        ("weather", "/weather"),
+        ("fetch_weather", city),
+    ]
+    inbox = stub.inbox(user_id)
+    for step, text in steps:
+        start = time.perf_counter()
+        await deliver(user_id, text)
+        await asyncio.wait_for(inbox.get(), args.timeout)
+        finish = time.perf_counter()
+        latencies.setdefault(step, []).append(finish - start)
+        spans.append((start, finish))
+        await asyncio.sleep(args.think_time)
+
+
+async def run(args):
+    """
+    Запускает заглушку, приложение бота и пользователей, печатает отчёт
+    """
+    stub = StubServer(delay=args.upstream_delay)
+    await stub.start()
+    base = f"http://127.0.0.1:{stub.port}"
+    workdir = tempfile.mkdtemp(prefix="weather-bench-")
+    os.environ.update({
+        "TOKEN": TOKEN,
+        "TELEGRAM_API_URL": f"{base}/bot",
+        "YANDEX_URL": f"{base}/pogoda/",
+        "NOMINATIM_URL": f"{base}/nominatim/search",
+        "OPEN_METEO_URL": f"{base}/v1/forecast",
+        "WEATHER_PROVIDERS": args.providers,
+        "USER_STORE": args.store,
+        "USER_DB": os.path.join(workdir, "users.sqlite3"),
+        "DATA_FILE": os.path.join(workdir, "user_data.json"),
+        "GEOCODE_DB": os.path.join(workdir, "geocode.sqlite3"),
+        "GEOCODE_FILE": os.path.join(workdir, "geocode_index.json"),
+        "YANDEX_URL_DB": os.path.join(workdir, "yandex_urls.sqlite3"),
+        "YANDEX_URL_FILE": os.path.join(workdir, "yandex_urls.json"),
+        "STATE_DB": os.path.join(workdir, "state.sqlite3"),
+        "METRICS_PORT": "0",
+        "GLOBAL_RATE": str(args.global_rate),
+        "GLOBAL_BURST": str(args.global_rate),
+    })
+    if args.no_cache:
+        os.environ["WEATHER_TTL"] = "0"
+        os.environ["OPEN_METEO_TTL"] = "0"
+
+    bot_module = load_bot()
+    # Заглушка не ограничивает частоту геокодирования
+    bot_module.NOMINATIM_INTERVAL = 0
+    application = bot_module.build_application()
+    await application.initialize()
+    # Без получения обновлений: их подаёт сам тест через process_update
+    await application.start()
+
+    users = FakeUsers(application.bot)
+    webhook = telegram = None
+    if args.mode == "webhook":
+        async def enqueue(data):
+            await application.update_queue.put(Update.de_json(data, application.bot))
+
+        webhook = bot_module.WebhookServer(enqueue, secret=WEBHOOK_SECRET)
+        port = await webhook.start("127.0.0.1", 0)
+        telegram = FakeTelegram(f"http://127.0.0.1:{port}{webhook.path}", WEBHOOK_SECRET)
+
+        async def deliver(user_id, text):
+            await telegram.post(users.payload(user_id, text))
+    else:
+        async def deliver(user_id, text):
+            await application.process_update(users.update(user_id, text))
+
+    latencies = {}
+    spans = []
+    limit = asyncio.Semaphore(args.concurrency)
+    errors = 0
+
+    async def user(user_id):
+        nonlocal errors
+        async with limit:
+            try:
+                await run_user(deliver, stub, user_id, latencies, spans, args)
+            except Exception as e:
+                errors += 1
+                print(f"Ошибка пользователя {user_id}: {e!r}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(1000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - start
+    # Время «раздумий» пользователей не входит в пропускную способность:
+    # считается только время, когда бот обрабатывал хотя бы один запрос
+    busy = busy_time(spans)
+
+    if webhook is not None:
+        await telegram.close()
+        await webhook.stop()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await stub.stop()
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"Пользователей: {args.users}, одновременно: {args.concurrency}, "
+          f"источники: {args.providers}, хранилище: {args.store}, режим: {args.mode}")
+    rate = f"{total / busy:.1f}" if busy > 0 else "—"
+    print(f"Обновлений: {total} за {elapsed:.2f} с, из них бот занят {busy:.2f} с — "
+          f"{rate} запросов/с без учёта раздумий, ошибок: {errors}")
+    print(f"{'шаг':<15}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for step, values in latencies.items():
+        values.sort()
+        print(f"{step:<15}" + "".join(
+            f"{percentile(values, share) * 1000:>10.1f}" for share in (0.5, 0.95, 0.99)))
+    peak = peak_memory()
+    print("Пик памяти (RSS): " + (f"{peak:.1f} МБ" if peak is not None else "неизвестен"))
+
+
+def main():
+    """
+    Разбор аргументов командной строки
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="число пользователей")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="сколько пользователей работают одновременно")
+    parser.add_argument("--providers", default="open-meteo",
+                        help="источники погоды, как WEATHER_PROVIDERS")
+    parser.add_argument("--store", default="sqlite", choices=["sqlite", "json"],
+                        help="хранилище пользователей")
+    parser.add_argument("--upstream-delay", type=float, default=0.0,
+                        help="искусственная задержка ответов сайтов погоды, секунды")
+    parser.add_argument("--mode", default="direct", choices=["direct", "webhook"],
+                        help="как подавать обновления: напрямую в приложение или через вебхук")
+    parser.add_argument("--no-cache", action="store_true", help="не кэшировать погоду")
+    parser.add_argument("--global-rate", type=float, default=1e9,
+                        help="общий лимит запросов погоды в секунду, по умолчанию без ограничения")
+    parser.add_argument("--think-time", type=float, default=0.05,
+                        help="пауза пользователя между шагами, секунды")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="сколько ждать ответа бота на один шаг, секунды")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Разбор страниц Яндекс Погоды по сохранённым HTML из fixtures без сети и браузера
+"""
+import asyncio
+import importlib.util
+import pathlib
+
+import httpx
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+FIXTURES = ROOT / "fixtures"
+
+spec = importlib.util.spec_from_file_location("bot", ROOT / "ВОТ_v1.2.py")
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+
+
+def fixture(name):
+    return (FIXTURES / name).read_text(encoding="utf-8")
+
+
+def test_forecast_page():
+    assert bot.parse_forecast_page(fixture("yandex_forecast.html")) == (
+        "+5", "+1", "Облачно с прояснениями", "Погода в Москве")
+
+
+def test_forecast_page_without_fields():
+    with pytest.raises(bot.PageParseError):
+        bot.parse_forecast_page(fixture("yandex_search.html"))
+
+
+def test_search_page_first_place():
+    assert bot.parse_search_page(fixture("yandex_search.html")) == "/pogoda/?lat=55.755863&lon=37.6177"
+
+
+def test_search_page_without_results():
+    with pytest.raises(bot.CityNotFound):
+        bot.parse_search_page(fixture("yandex_search_empty.html"))
+
+
+def test_unknown_page():
+    assert bot.parse_search_page(fixture("yandex_captcha.html")) is None
+
+
+def fetch(city, pages):
+    """
+    Запрос через YandexHttpFetcher, где сайт заменён страницами из fixtures
+    """
+    def handler(request):
+        if request.url.path.endswith("/search"):
+            return httpx.Response(200, text=fixture(pages["search"]))
+        return httpx.Response(200, text=fixture(pages["forecast"]))
+
+    async def run():
+        fetcher = bot.YandexHttpFetcher("https://yandex.ru/pogoda/")
+        await fetcher.client.aclose()
+        fetcher.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await fetcher.fetch(city)
+        finally:
+            await fetcher.close()
+    return asyncio.run(run())
+
+
+def test_fetch_follows_search_result():
+    result = fetch("Москва", {"search": "yandex_search.html", "forecast": "yandex_forecast.html"})
+    assert result[0] == "+5"
+
+
+def test_fetch_unknown_city_skips_browser():
+    with pytest.raises(bot.CityNotFound):
+        fetch("Мсоква", {"search": "yandex_search_empty.html", "forecast": "yandex_forecast.html"})
+
+
+def test_fetch_unknown_page_falls_back():
+    with pytest.raises(bot.PageParseError):
+        fetch("Москва", {"search": "yandex_captcha.html", "forecast": "yandex_forecast.html"})
@@ -2,259 +2,3932 @@
 Модуль для получения погоды с помощью телеграм бота
 """
 import os
+import re
+import sys
+import copy
+import hmac
 import json
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
+import sqlite3
+import random
+import signal
+import shutil
+import asyncio
+import tempfile
+import threading
+import time
+import uuid
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+import httpx
+from telegram import Bot, Update, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler
 from telegram.ext import ConversationHandler, filters
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.error import Forbidden, RetryAfter
 from dotenv import load_dotenv
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-
-# Файл для хранения данных пользователей
+# Selenium импортируется только при первом запуске браузера или фоновом прогреве,
+# чтобы не задерживать старт бота
+
+# Файл для хранения данных пользователей (старый формат) и база SQLite
 DATA_FILE = "user_data.json"
+USER_DB = "users.sqlite3"
 
-class SettingsHandler:
+# Интервал сброса изменённых профилей из памяти в хранилище, секунды
+USER_FLUSH_INTERVAL = 5
+
+# База состояний диалогов и user_data, интервал их записи и срок хранения
+# брошенных диалогов и данных неактивных пользователей, секунды
+STATE_DB = "state.sqlite3"
+STATE_FLUSH_INTERVAL = 10
+STATE_TTL = 3600
+
+# Размер пула браузеров и число использований сессии до пересоздания
+CHROME_POOL_SIZE = 2
+CHROME_MAX_USES = 50
+
+# Ограничения очереди парсинга: число ожидающих задач и таймаут одного запроса
+SCRAPE_QUEUE_SIZE = 20
+SCRAPE_TIMEOUT = 40
+
+# Профили браузера для парсинга: "light" не загружает картинки, шрифты,
+# стили, рекламу и счётчики и не ждёт полной загрузки страницы, "full" грузит всё
+BROWSER_PROFILE = "light"
+BROWSER_PROFILES = {
+    "full": {
+        "page_load_strategy": "normal",
+        "prefs": {},
+        "blocked_urls": [],
+    },
+    "light": {
+        # Ждём только DOMContentLoaded: нужные поля уже есть в разметке
+        "page_load_strategy": "eager",
+        # 2 — запретить для всех сайтов
+        "prefs": {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.managed_default_content_settings.stylesheets": 2,
+            "profile.managed_default_content_settings.plugins": 2,
+            "profile.managed_default_content_settings.popups": 2,
+            "profile.managed_default_content_settings.geolocation": 2,
+            "profile.managed_default_content_settings.notifications": 2,
+            "profile.managed_default_content_settings.media_stream": 2,
+        },
+        # Шаблоны адресов, запросы к которым браузер отменяет сам (CDP Network.setBlockedURLs)
+        "blocked_urls": [
+            "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+            "*.woff", "*.woff2", "*.ttf", "*.otf", "*.css",
+            "*.mp4", "*.webm",
+            "*mc.yandex.ru*", "*an.yandex.ru*", "*yabs.yandex.ru*",
+            "*ads.adfox.ru*", "*googletagmanager.com*", "*google-analytics.com*",
+            "*doubleclick.net*", "*top-fwz1.mail.ru*",
+        ],
+    },
+}
+
+# Надзор за процессами браузера: предел памяти одной сессии (chromedriver и все его
+# процессы Chrome, байты), сколько секунд сессия может быть занята одним запросом,
+# как часто проверять (секунды) и через сколько секунд после запуска
+# непривязанный к пулу процесс chromedriver/Chrome считается потерянным.
+# Каждая сессия получает свой каталог профиля в CHROME_PROFILE_ROOT: по нему
+# надзор отличает процессы бота от любых других Chrome на машине
+CHROME_RSS_BUDGET = 512 * 1024 * 1024
+CHROME_SESSION_BUDGET = 60
+CHROME_SUPERVISOR_INTERVAL = 30
+CHROME_ORPHAN_GRACE = 120
+CHROME_PROFILE_ROOT = os.path.join(tempfile.gettempdir(), "weather-bot-chrome")
+
+# Фоновый прогрев браузера после старта: "import" — только импорт Selenium,
+# "launch" — ещё и запуск одной сессии Chrome, "off" — всё при первом запросе
+BROWSER_WARMUP = "import"
+
+# Общий срок на загрузку и разбор страницы в браузере, секунды
+SCRAPE_DEADLINE = 20
+
+# Скрипт, за один вызов собирающий все поля со страницы прогноза
+EXTRACT_SCRIPT = """
+const text = (selector) => {
+    const element = document.querySelector(selector);
+    return element ? element.innerText.trim() : null;
+};
+return [
+    text('.fact__temp .temp__value'),
+    text('.fact__feels-like .temp__value'),
+    text('.link__condition'),
+    text('.title.title_level_1.header-title__title'),
+];
+"""
+
+# Время жизни погоды в кэше по источникам (секунды) и ограничение памяти кэша
+WEATHER_TTL = {"yandex": 600, "open-meteo": 900}
+WEATHER_CACHE_BYTES = 4 * 1024 * 1024
+
+# Страница погоды Яндекса и заголовки для запросов без браузера
+YANDEX_URL = "https://yandex.ru/pogoda/"
+YANDEX_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                  "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept-Language": "ru-RU,ru;q=0.9",
+}
+
+# База с адресами страниц прогноза Яндекса для уже найденных городов (общая для всех
+# процессов бота) и файл прежнего формата, из которого она заполняется при первом запуске
+YANDEX_URL_DB = "yandex_urls.sqlite3"
+YANDEX_URL_FILE = "yandex_urls.json"
+
+# Open-Meteo и Nominatim: адреса, база координат городов (и файл прежнего формата),
+# минимальный интервал между запросами к Nominatim и сколько точек просить
+# у Open-Meteo одним пакетным запросом
+OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_HEADERS = {"User-Agent": "WeatherBot/1.2 (your_email@example.com)"}
+NOMINATIM_INTERVAL = 1.0
+GEOCODE_DB = "geocode.sqlite3"
+GEOCODE_FILE = "geocode_index.json"
+OPEN_METEO_BATCH = 100
+
+# Повторы HTTP-запросов к API: число попыток и базовая задержка
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+
+# Источники погоды в порядке предпочтения, задержка перед дублирующим запросом, секунды,
+# и сколько городов запрашивать одновременно, если пакетный запрос не удался
+WEATHER_PROVIDERS = "open-meteo,yandex"
+HEDGE_DELAY = 2.5
+FALLBACK_CONCURRENCY = 10
+
+# Сколько ошибок подряд выводят источник из строя и на сколько секунд
+PROVIDER_MAX_FAILURES = 3
+PROVIDER_COOLDOWN = 60
+
+# Автоматы защиты сайтов погоды: по скольким последним запросам считать,
+# при какой доле ошибок (и не меньше скольких запросов) отключать сайт и на сколько секунд,
+# во сколько раз таймаут больше 95-го перцентиля задержки
+BREAKER_WINDOW = 20
+BREAKER_ERROR_RATE = 0.5
+BREAKER_MIN_REQUESTS = 5
+BREAKER_COOLDOWN = 30
+BREAKER_TIMEOUT_FACTOR = 3
+# Пределы таймаута запроса к каждому сайту, секунды
+UPSTREAM_TIMEOUTS = {
+    "yandex-http": (2, 10),
+    "yandex-browser": (10, 40),
+    "open-meteo": (1, 10),
+    "nominatim": (2, 10),
+}
+
+# Прогрев популярных городов: сколько городов, как часто (секунды), за сколько секунд
+# до истечения кэша обновлять и сколько обновлений выполнять одновременно.
+# Города с весом ниже PREWARM_MIN_WEIGHT забываются, всего учитывается
+# не больше PREWARM_MAX_CITIES городов
+PREWARM_TOP_N = 20
+PREWARM_INTERVAL = 60
+PREWARM_MARGIN = 120
+PREWARM_CONCURRENCY = 3
+PREWARM_MIN_WEIGHT = 0.1
+PREWARM_MAX_CITIES = 1000
+
+# Подписки: смещение от UTC по умолчанию (часы) и ограничения Telegram на отправку —
+# сообщений в секунду на бота и минимальный интервал между сообщениями в один чат
+DEFAULT_UTC_OFFSET = 3
+DELIVERY_RATE = 25
+DELIVERY_CHAT_INTERVAL = 1.0
+DELIVERY_WORKERS = 8
+
+# Ограничение запросов погоды: запросов в секунду и запас на пользователя и на весь бот,
+# сколько пользователей помнить, при какой очереди запросов к источникам отдавать
+# устаревшие данные из кэша и насколько устаревшие (секунды после истечения срока жизни)
+USER_RATE = 0.2
+USER_BURST = 3
+GLOBAL_RATE = 20
+GLOBAL_BURST = 40
+RATE_USERS_MAX = 10000
+SHED_BACKLOG = 10
+STALE_MAX_AGE = 1800
+
+# Локальный HTTP-адрес для метрик в формате Prometheus и границы гистограмм задержки.
+# По умолчанию сервер метрик выключен (порт 0), включается переменной METRICS_PORT
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Режим получения обновлений: "polling" или "webhook".
+# Для вебхука: адрес и порт локального сервера, путь, публичный адрес для setWebhook,
+# секрет из заголовка X-Telegram-Bot-Api-Secret-Token (обязателен: без него режимы
+# webhook, ingress и cluster не запускаются), предельный размер запроса (байты)
+# и сколько ждать обработки принятых обновлений при остановке (секунды)
+BOT_MODE = "polling"
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_MAX_BODY = 1024 * 1024
+WEBHOOK_DRAIN_TIMEOUT = 30
+
+# Горизонтальное масштабирование (BOT_MODE=ingress/worker/cluster): база общей очереди
+# обновлений, число обработчиков, пачка обновлений за один проход и интервал опроса, секунды,
+# и сколько секунд в режиме cluster обработчики дорабатывают очередь после остановки приёмника
+UPDATE_QUEUE_DB = "updates.sqlite3"
+WORKER_COUNT = 2
+WORKER_BATCH = 100
+WORKER_POLL_INTERVAL = 0.05
+WORKER_DRAIN_TIMEOUT = 60
+
+# Расшифровка погодных кодов Open-Meteo
+WEATHER_CODES = {
+    0: "Ясно ☀️",
+    1: "Преимущественно ясно 🌤️",
+    2: "Переменная облачность ⛅",
+    3: "Пасмурно ☁️",
+    45: "Туман 🌫️",
+    48: "Туман с изморозью 🌫️❄️",
+    51: "Слабая морось 🌦️",
+    61: "Слабой интенсивности дождь 🌧️",
+    71: "Слабой интенсивности снегопад 🌨️",
+    80: "Грозы 🌩️",
+}
+
+
+class Metrics:
+    """
+    Счётчики, гистограммы задержек и показатели состояния,
+    отдаваемые по HTTP в текстовом формате Prometheus
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def inc(self, name, value=1, **labels):
+        """
+        Увеличивает счётчик
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Добавляет значение в гистограмму
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def gauge(self, name, func, **labels):
+        """
+        Регистрирует показатель, значение которого вычисляет func() при чтении
+        """
+        self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        Замеряет длительность этапа обработки запроса
+        и считает ошибки на нём
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("weather_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("weather_stage_seconds", time.perf_counter() - start,
+                         stage=stage, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        text = ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in items)
+        return "{" + text + "}"
+
+    def render(self):
+        """
+        Текст всех метрик в формате Prometheus
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        for (name, labels), value in counters:
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            for bound, count in zip(self.buckets, hist):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        for (name, labels), func in sorted(self._gauges.items(), key=lambda item: item[0]):
+            try:
+                lines.append(f"{name}{self._labels(labels)} {func()}")
+            except Exception as e:
+                print(f"Ошибка чтения метрики {name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.split()
+            if len(parts) > 1 and parts[1] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        """
+        Запускает HTTP-сервер метрик: GET /metrics.
+        Если порт занят, бот продолжает работу без сервера метрик
+        """
+        try:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            print(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+
+    async def stop(self):
+        """
+        Останавливает HTTP-сервер метрик
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+# Общий реестр метрик бота
+METRICS = Metrics()
+
+
+def normalize_city(name):
+    """
+    Приводит название города к ключу кэша:
+    без учёта регистра, лишних пробелов и различия ё/е
+    """
+    return " ".join(name.casefold().replace("ё", "е").split())
+
+
+def _sizeof(value):
+    """
+    Приблизительный объём значения в памяти вместе с вложенными элементами
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_sizeof(item) for item in value)
+    elif hasattr(value, "__dict__"):
+        size += _sizeof(vars(value))
+    return size
+
+
+def parse_temperature(text):
+    """
+    Переводит температуру со страницы ("+5", "−3°") в число или None
+    """
+    try:
+        return float(text.replace("−", "-").replace("°", "").strip())
+    except (AttributeError, ValueError):
+        return None
+
+
+@dataclass
+class WeatherResult:
+    """
+    Общий результат всех источников погоды
+    """
+    source: str
+    city: str
+    temp: float = None
+    feels_like: float = None
+    condition: str = ""
+    temp_min: float = None
+    temp_max: float = None
+    precipitation: float = None
+
+    def format(self):
+        """
+        Текст ответа пользователю; отсутствующие у источника поля пропускаются
+        """
+        temp = f"{self.temp:+g}" if self.temp is not None else "нет данных"
+        lines = [f"Текущая температура в {self.city}: {temp}°C"]
+        if self.feels_like is not None:
+            lines.append(f"Ощущается как: {self.feels_like:+g}°C")
+        if self.condition:
+            lines.append(f"Условия: {self.condition}")
+        if self.temp_min is not None and self.temp_max is not None:
+            lines.append(f"За сутки: {self.temp_min:+g}°C … {self.temp_max:+g}°C")
+        if self.precipitation is not None:
+            lines.append(f"Осадки: {self.precipitation:g} мм")
+        return "\n".join(lines)
+
+
+class WeatherCache:
+    """
+    Кэш результатов погоды с временем жизни по источникам и вытеснением
+    давно не использованных записей при превышении лимита памяти.
+    Одновременные промахи по одному городу объединяются в один запрос.
+    Истёкшие записи хранятся ещё stale секунд для выдачи под нагрузкой
+    """
+    def __init__(self, ttl=None, max_bytes=WEATHER_CACHE_BYTES, stale=STALE_MAX_AGE):
+        self.ttl = dict(WEATHER_TTL, **(ttl or {}))
+        self.max_bytes = max_bytes
+        self.stale = stale
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def memory(self):
+        """
+        Приблизительный объём кэша в байтах
+        """
+        return self._bytes
+
+    @property
+    def inflight(self):
+        """
+        Число выполняющихся запросов к источникам
+        """
+        return len(self._inflight)
+
+    def get(self, source, city):
+        """
+        Возвращает свежее значение из кэша или None
+        """
+        return self.get_stale(source, city, 0)
+
+    def get_stale(self, source, city, max_age):
+        """
+        Возвращает значение, истёкшее не больше max_age секунд назад, или None
+        """
+        key = (source, normalize_city(city))
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, _, value = entry
+        now = time.monotonic()
+        if expires + self.stale < now:
+            self._drop(key)
+            return None
+        if expires + max_age < now:
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def expires_in(self, source, city):
+        """
+        Сколько секунд осталось жить записи или None, если её нет
+        """
+        entry = self._entries.get((source, normalize_city(city)))
+        if entry is None:
+            return None
+        return entry[0] - time.monotonic()
+
+    def put(self, source, city, value):
+        """
+        Сохраняет значение и вытесняет старые записи сверх лимита памяти
+        """
+        self._store((source, normalize_city(city)), value)
+
+    def _store(self, key, value):
+        if key in self._entries:
+            self._drop(key)
+        size = _sizeof(key) + _sizeof(value)
+        expires = time.monotonic() + self.ttl.get(key[0], 0)
+        self._entries[key] = (expires, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    async def get_or_fetch(self, source, city, fetch):
+        """
+        Возвращает значение из кэша, а при промахе вызывает корутину fetch().
+        Пока запрос по городу выполняется, остальные ждут его результата
+        """
+        value = self.get(source, city)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        return await self.refresh(source, city, fetch)
+
+    async def refresh(self, source, city, fetch):
+        """
+        Загружает значение заново, не глядя в кэш, и сохраняет его.
+        Пока запрос по городу выполняется, остальные ждут его результата
+        """
+        key = (source, normalize_city(city))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._store(key, task.result())
+
+
+class RateLimited(Exception):
+    """
+    Запрос отклонён ограничением частоты запросов
+    """
+
+
+class ScrapeQueueFull(Exception):
+    """
+    Очередь парсинга переполнена, новый запрос не принят
+    """
+
+
+class ScrapeCancelled(Exception):
+    """
+    Запрос парсинга отменён по таймауту или при остановке бота
+    """
+
+
+class CityNotFound(Exception):
+    """
+    Источник погоды не нашёл город
+    """
+
+
+class PageParseError(Exception):
+    """
+    На странице не найдены нужные данные о погоде
+    """
+
+
+class CircuitOpen(Exception):
+    """
+    Сайт погоды временно отключён автоматом защиты
+    """
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты одного сайта погоды по последним window запросам.
+    Если среди них доля ошибок не меньше error_rate, автомат размыкается
+    на cooldown секунд и запросы сразу отклоняются с CircuitOpen. Затем пропускается
+    один пробный запрос: успех замыкает автомат, ошибка снова размыкает.
+    Таймаут запроса — factor × 95-й перцентиль задержки успешных запросов
+    в пределах от timeout_min до timeout_max
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name, timeout_min, timeout_max, window=BREAKER_WINDOW,
+                 error_rate=BREAKER_ERROR_RATE, min_requests=BREAKER_MIN_REQUESTS,
+                 cooldown=BREAKER_COOLDOWN, factor=BREAKER_TIMEOUT_FACTOR):
+        self.name = name
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.factor = factor
+        self.state = self.CLOSED
+        self.open_until = 0.0
+        self._results = deque(maxlen=window)  # (успех, задержка)
+        self._probe = False
+        METRICS.gauge("circuit_state", lambda: self.state, upstream=name)
+        METRICS.gauge("circuit_timeout_seconds", self.timeout, upstream=name)
+
+    @classmethod
+    def for_upstream(cls, name):
+        """
+        Автомат с пределами таймаута из UPSTREAM_TIMEOUTS
+        """
+        return cls(name, *UPSTREAM_TIMEOUTS.get(name, (1, 10)))
+
+    def timeout(self):
+        """
+        Текущий таймаут запроса, секунды
+        """
+        latencies = sorted(latency for ok, latency in self._results if ok)
+        if len(latencies) < self.min_requests:
+            return self.timeout_max
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        return min(self.timeout_max, max(self.timeout_min, p95 * self.factor))
+
+    def allow(self):
+        """
+        Можно ли отправить запрос сейчас
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe = False
+        if self.state == self.HALF_OPEN:
+            if self._probe:
+                return False
+            self._probe = True
+        return True
+
+    def record(self, ok, latency):
+        """
+        Учитывает результат запроса и при необходимости переключает автомат
+        """
+        if self.state == self.HALF_OPEN:
+            self._probe = False
+            if ok:
+                self.state = self.CLOSED
+                self._results.clear()
+                self._results.append((ok, latency))
+            else:
+                self._trip()
+            return
+        self._results.append((ok, latency))
+        failures = sum(1 for ok, _ in self._results if not ok)
+        if (len(self._results) >= self.min_requests
+                and failures / len(self._results) >= self.error_rate):
+            self._trip()
+
+    def _trip(self):
+        self.state = self.OPEN
+        self.open_until = time.monotonic() + self.cooldown
+        METRICS.inc("circuit_trips_total", upstream=self.name)
+        print(f"Сайт {self.name} отключён на {self.cooldown} с после серии ошибок")
+
+    async def call(self, func, ignored=()):
+        """
+        Выполняет корутину func() с текущим таймаутом и учитывает результат.
+        Исключения из ignored не считаются ни успехом, ни ошибкой сайта
+        """
+        if not self.allow():
+            METRICS.inc("circuit_rejected_total", upstream=self.name)
+            raise CircuitOpen(f"Сайт {self.name} временно отключён")
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(func(), self.timeout())
+        except (asyncio.CancelledError, *ignored):
+            self._probe = False
+            raise
+        except Exception:
+            self.record(False, time.monotonic() - start)
+            raise
+        self.record(True, time.monotonic() - start)
+        return result
+
+
+class YandexPageParser(HTMLParser):
+    """
+    Разбирает HTML страницы погоды Яндекса и собирает текст тех же элементов,
+    которые читает браузер: температура, ощущаемая температура, условия,
+    название города, а также первая ссылка из списка найденных городов
+    и признак того, что это страница поиска
+    """
+    # Селекторы полей: классы элементов от внешнего к внутреннему
+    FIELDS = {
+        "temp": ({"fact__temp"}, {"temp__value"}),
+        "feels_like": ({"fact__feels-like"}, {"temp__value"}),
+        "condition": ({"link__condition"},),
+        "name_city": ({"title", "title_level_1", "header-title__title"},),
+    }
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "link", "meta", "source", "track", "wbr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._stack = []
+        self._open = {}
+        self.fields = {}
+        self.place_link = None
+        self.search_page = False
+
+    def _matches(self, selector):
+        """
+        Проверяет, подходит ли текущий элемент под селектор из вложенных классов
+        """
+        if not selector[-1] <= self._stack[-1][1]:
+            return False
+        rest = list(selector[:-1])
+        for _, classes, _ in reversed(self._stack[:-1]):
+            if rest and rest[-1] <= classes:
+                rest.pop()
+        return not rest
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = set((attrs.get("class") or "").split())
+        self._stack.append((tag, classes, attrs.get("href")))
+
+        for name, selector in self.FIELDS.items():
+            if name not in self.fields and name not in self._open and self._matches(selector):
+                self._open[name] = len(self._stack)
+                self.fields[name] = []
+
+        if "search-form" in classes or "place-list" in classes:
+            self.search_page = True
+        if self.place_link is None and "place-list__item-name" in classes:
+            # Ссылка на город — сам элемент или ближайший родитель с href
+            for _, _, href in reversed(self._stack):
+                if href:
+                    self.place_link = href
+                    break
+
+        if tag in self.VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        for depth in range(len(self._stack), 0, -1):
+            if self._stack[depth - 1][0] == tag:
+                del self._stack[depth - 1:]
+                break
+        else:
+            return
+        for name, depth in list(self._open.items()):
+            if depth > len(self._stack):
+                del self._open[name]
+
+    def handle_data(self, data):
+        for name in self._open:
+            self.fields[name].append(data)
+
+    def result(self):
+        """
+        Возвращает собранный текст полей без лишних пробелов
+        """
+        return {name: " ".join("".join(parts).split()) for name, parts in self.fields.items()}
+
+
+def parse_forecast_page(html):
+    """
+    Извлекает из страницы прогноза температуру, ощущаемую температуру,
+    условия и название города. При отсутствии любого поля бросает PageParseError
+    """
+    parser = YandexPageParser()
+    parser.feed(html)
+    parser.close()
+    fields = parser.result()
+    missing = [name for name in YandexPageParser.FIELDS if not fields.get(name)]
+    if missing:
+        raise PageParseError(f"На странице нет полей: {', '.join(missing)}")
+    return fields["temp"], fields["feels_like"], fields["condition"], fields["name_city"]
+
+
+def parse_search_page(html):
+    """
+    Возвращает ссылку на первый найденный город со страницы поиска.
+    Для страницы поиска без результатов бросает CityNotFound,
+    для неизвестной страницы (капча, новая вёрстка) возвращает None
+    """
+    parser = YandexPageParser()
+    parser.feed(html)
+    parser.close()
+    if parser.place_link is None and parser.search_page:
+        raise CityNotFound("Город не найден на странице поиска")
+    return parser.place_link
+
+
+class CityIndex:
+    """
+    Значения по нормализованному названию города в SQLite. Одна база общая
+    для всех процессов бота: запись идёт по ключу, без перезаписи всего индекса.
+    Найденные значения запоминаются в памяти процесса, промахи всегда читаются
+    из базы, чтобы видеть записи других процессов. При первом запуске индекс
+    заполняется из JSON файла прежнего формата, если он есть.
+    Используется и из потоков браузера, и из цикла событий
+    """
+    def __init__(self, db_file, legacy_file=None):
+        self.db_file = db_file
+        self._conn = sqlite3.connect(
+            db_file, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cities (city TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._lock = threading.Lock()
+        self._cache = {}
+        if legacy_file is not None:
+            self._import(legacy_file)
+
+    def _import(self, path):
+        """
+        Переносит записи из JSON файла в пустую базу. Повреждённый файл пропускается
+        """
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM cities LIMIT 1").fetchone():
+                return
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Файл {path} не прочитан: {e}")
+            return
+        if not isinstance(data, dict):
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO cities (city, value) VALUES (?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in data.items()])
+
+    def get(self, city):
+        """
+        Возвращает значение для города или None
+        """
+        key = normalize_city(city)
+        if key in self._cache:
+            return self._cache[key]
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cities WHERE city = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value = self._cache[key] = json.loads(row[0])
+        return value
+
+    def put(self, city, value):
+        """
+        Запоминает значение для города
+        """
+        key = normalize_city(city)
+        if self._cache.get(key) == value:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cities (city, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)))
+        self._cache[key] = value
+
+    def drop(self, city):
+        """
+        Забывает значение для города
+        """
+        key = normalize_city(city)
+        with self._lock:
+            self._conn.execute("DELETE FROM cities WHERE city = ?", (key,))
+        self._cache.pop(key, None)
+
+    def close(self):
+        """
+        Закрывает соединение с базой
+        """
+        with self._lock:
+            self._conn.close()
+
+
+class ForecastUrlIndex(CityIndex):
+    """
+    Адреса страниц прогноза Яндекса по нормализованному названию города,
+    чтобы повторные запросы шли сразу на прогноз без страницы поиска.
+    Устаревший адрес, с которого не удалось получить погоду, удаляется через drop()
+    """
+    def __init__(self, db_file=YANDEX_URL_DB, legacy_file=YANDEX_URL_FILE):
+        super().__init__(db_file, legacy_file)
+
+
+class YandexHttpFetcher:
+    """
+    Получение погоды с Яндекса обычными HTTP-запросами без браузера.
+    Соединения переиспользуются общим клиентом, найденные адреса
+    прогноза запоминаются в индексе urls
+    """
+    def __init__(self, base_url=YANDEX_URL, urls=None, timeout=10):
+        self.base_url = base_url
+        self.urls = urls
+        self.client = httpx.AsyncClient(
+            headers=YANDEX_HEADERS,
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+
+    async def fetch(self, city):
+        """
+        Загружает прогноз по адресу из индекса, а если его нет или он устарел —
+        ищет город и разбирает страницу прогноза.
+        Если поиск сразу перенаправил на прогноз, второй запрос не нужен.
+        Пустой результат поиска — CityNotFound, браузер для него не нужен
+        """
+        url = self.urls.get(city) if self.urls is not None else None
+        if url is not None:
+            try:
+                response = await self.client.get(url)
+                response.raise_for_status()
+                return parse_forecast_page(response.text)
+            except (httpx.HTTPStatusError, PageParseError) as e:
+                print(f"Адрес прогноза для {city} устарел: {e}")
+                self.urls.drop(city)
+
+        response = await self.client.get(
+            urljoin(self.base_url, "search"), params={"request": city})
+        response.raise_for_status()
+        try:
+            fields = parse_forecast_page(response.text)
+        except PageParseError as e:
+            link = parse_search_page(response.text)
+            if link is None:
+                raise PageParseError(f"Не удалось разобрать страницу поиска для {city}") from e
+            response = await self.client.get(urljoin(str(response.url), link))
+            response.raise_for_status()
+            fields = parse_forecast_page(response.text)
+        if self.urls is not None:
+            self.urls.put(city, str(response.url))
+        return fields
+
+    async def close(self):
+        """
+        Закрывает соединения клиента
+        """
+        await self.client.aclose()
+
+
+class ChromePool:
+    """
+    Ограниченный пул «тёплых» сессий Chrome.
+    Выдаёт драйверы во временное пользование, проверяет их работоспособность
+    и пересоздаёт сессию после max_uses использований или после сбоя.
+    Новые сессии создаёт функция launch()
+    """
+    def __init__(self, launch, size=CHROME_POOL_SIZE, max_uses=CHROME_MAX_USES,
+                 blocked_urls=()):
+        self.launch = launch
+        self.blocked_urls = list(blocked_urls)
+        self.size = size
+        self.max_uses = max_uses
+        self._idle = []
+        self._uses = {}
+        self._leased = {}  # id драйвера -> (драйвер, когда выдан)
+        self._killed = set()
+        self._alive = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _launch(self):
+        """
+        Запускает новую сессию браузера
+        """
+        with METRICS.span("browser_launch"):
+            driver = self.launch()
+        if self.blocked_urls:
+            try:
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.blocked_urls})
+            except Exception:
+                driver.quit()
+                raise
+        self._uses[id(driver)] = 0
+        return driver
+
+    def _quit(self, driver):
+        """
+        Закрывает сессию, не пропуская наружу ошибки упавшего браузера
+        """
+        self._uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"Ошибка при закрытии браузера: {e}")
+
+    @staticmethod
+    def is_healthy(driver):
+        """
+        Проверяет, что браузер ещё отвечает на команды
+        """
+        try:
+            _ = driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Выдаёт свободную сессию, при необходимости запуская новую.
+        Если все сессии заняты, ждёт не дольше timeout секунд
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Пул браузеров закрыт")
+                if self._idle:
+                    driver = self._idle.pop()
+                    break
+                if self._alive < self.size:
+                    self._alive += 1
+                    driver = None
+                    break
+                if not self._cond.wait(timeout):
+                    raise TimeoutError("Нет свободных сессий браузера")
+
+        # Запуск и проверка выполняются вне блокировки: место в пуле уже занято
+        try:
+            if driver is not None and not self.is_healthy(driver):
+                self._quit(driver)
+                driver = None
+            if driver is None:
+                driver = self._launch()
+        except Exception:
+            with self._cond:
+                self._alive -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._leased[id(driver)] = (driver, time.monotonic())
+        return driver
+
+    def release(self, driver, broken=False):
+        """
+        Возвращает сессию в пул. Сломанные и отработавшие своё сессии закрываются
+        """
+        uses = self._uses.get(id(driver), 0) + 1
+        self._uses[id(driver)] = uses
+        with self._cond:
+            self._leased.pop(id(driver), None)
+            # Сессию, убитую надзором, нельзя возвращать в пул
+            if id(driver) in self._killed:
+                self._killed.discard(id(driver))
+                broken = True
+            keep = not broken and not self._closed and uses < self.max_uses
+            if keep:
+                self._idle.append(driver)
+            else:
+                self._alive -= 1
+            self._cond.notify()
+        if not keep:
+            self._quit(driver)
+
+    @contextmanager
+    def session(self, timeout=None):
+        """
+        Контекстный менеджер: выдаёт сессию и возвращает её в пул по выходу.
+        После исключения сессия проверяется и при сбое пересоздаётся
+        """
+        driver = self.acquire(timeout)
+        broken = False
+        try:
+            yield driver
+        except Exception:
+            broken = not self.is_healthy(driver)
+            raise
+        finally:
+            self.release(driver, broken)
+
+    def warm(self):
+        """
+        Заранее запускает одну сессию, чтобы первый запрос не ждал запуска браузера
+        """
+        self.release(self.acquire(), broken=False)
+
+    def sessions(self):
+        """
+        Все запущенные сессии: список (драйвер, с какого момента занята или None)
+        """
+        with self._cond:
+            return [(driver, None) for driver in self._idle] + list(self._leased.values())
+
+    def discard(self, driver):
+        """
+        Убирает из пула сессию, процессы которой завершены извне.
+        Свободная закрывается сразу, занятая — при возврате в пул
+        """
+        with self._cond:
+            if driver in self._idle:
+                self._idle.remove(driver)
+                self._alive -= 1
+                self._cond.notify()
+            else:
+                if id(driver) in self._leased:
+                    self._killed.add(id(driver))
+                return
+        self._quit(driver)
+
+    def stats(self):
+        """
+        Возвращает число живых и свободных сессий
+        """
+        with self._cond:
+            return {"alive": self._alive, "idle": len(self._idle), "size": self.size}
+
+    def close(self):
+        """
+        Закрывает все свободные сессии; занятые закроются при возврате
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._alive -= len(idle)
+            self._cond.notify_all()
+        for driver in idle:
+            self._quit(driver)
+
+
+class ChromeSupervisor:
+    """
+    Надзор за процессами браузеров пула: считает процессы и память каждой сессии
+    (chromedriver со всеми потомками), убивает сессии сверх rss_budget байт или занятые
+    дольше session_budget секунд, добивает процессы сессий, потерянные этим или упавшим
+    прежним запуском бота, удаляет их каталоги профилей и собирает завершившиеся
+    дочерние процессы. Своими считаются только процессы, в командной строке которых
+    есть каталог сессии из profile_root; имя каталога начинается с PID и времени
+    запуска процесса-владельца. Требует psutil; без него надзор отключается
+    """
+    DRIVER_NAMES = ("chromedriver", "chromedriver.exe")
+    BROWSER_NAMES = ("chrome", "chrome.exe", "chromium", "chromium-browser", "google-chrome")
+
+    def __init__(self, pool, rss_budget=CHROME_RSS_BUDGET, session_budget=CHROME_SESSION_BUDGET,
+                 orphan_grace=CHROME_ORPHAN_GRACE, profile_root=CHROME_PROFILE_ROOT):
+        self.pool = pool
+        self.rss_budget = rss_budget
+        self.session_budget = session_budget
+        self.orphan_grace = orphan_grace
+        self.profile_root = profile_root
+        self.processes = 0
+        self.rss = 0
+        try:
+            import psutil
+            self.psutil = psutil
+        except ImportError:
+            self.psutil = None
+            print("psutil не установлен, надзор за процессами браузера отключён")
+        self.owner = self.owner_tag(os.getpid())
+
+    def owner_tag(self, pid):
+        """
+        Метка процесса бота: PID и время его запуска, чтобы не спутать
+        с новым процессом, получившим тот же PID
+        """
+        started = 0
+        if self.psutil is not None:
+            try:
+                started = int(self.psutil.Process(pid).create_time())
+            except self.psutil.Error:
+                pass
+        return f"{pid}-{started}"
+
+    def session_dir(self):
+        """
+        Создаёт каталог профиля новой сессии браузера и возвращает путь к нему
+        """
+        path = os.path.join(self.profile_root, f"{self.owner}-{uuid.uuid4().hex}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def session_of(self, cmdline):
+        """
+        Имя каталога сессии из командной строки процесса или None, если процесс не наш
+        """
+        prefix = os.path.join(self.profile_root, "")
+        for arg in cmdline or ():
+            _, found, rest = arg.partition(prefix)
+            if found:
+                return re.split(r"[\\/]", rest, maxsplit=1)[0]
+        return None
+
+    def owner_alive(self, session):
+        """
+        Жив ли процесс бота, создавший сессию
+        """
+        pid, _, rest = session.partition("-")
+        started = rest.partition("-")[0]
+        if not pid.isdigit():
+            return False
+        return self.owner_tag(int(pid)) == f"{pid}-{started}"
+
+    @staticmethod
+    def driver_pid(driver):
+        """
+        PID процесса chromedriver сессии или None
+        """
+        process = getattr(getattr(driver, "service", None), "process", None)
+        return getattr(process, "pid", None)
+
+    def tree(self, pid):
+        """
+        Процесс и все его потомки, которые ещё живы
+        """
+        try:
+            root = self.psutil.Process(pid)
+            return [root] + root.children(recursive=True)
+        except self.psutil.Error:
+            return []
+
+    def memory(self, processes):
+        """
+        Суммарная резидентная память процессов, байты
+        """
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except self.psutil.Error:
+                pass
+        return total
+
+    def kill(self, processes, reason):
+        """
+        Завершает процессы и дожидается их
+        """
+        for process in processes:
+            try:
+                process.kill()
+            except self.psutil.Error:
+                pass
+        self.psutil.wait_procs(processes, timeout=3)
+        METRICS.inc("chrome_killed_total", value=len(processes), reason=reason)
+
+    def check(self):
+        """
+        Один проход надзора. Возвращает PID процессов живых сессий
+        """
+        tracked = set()
+        processes = 0
+        rss = 0
+        now = time.monotonic()
+        for driver, leased_since in self.pool.sessions():
+            pid = self.driver_pid(driver)
+            if pid is None:
+                continue
+            tree = self.tree(pid)
+            size = self.memory(tree)
+            reason = None
+            if size > self.rss_budget:
+                reason = "memory"
+            elif leased_since is not None and now - leased_since > self.session_budget:
+                reason = "time"
+            if reason is not None:
+                print(f"Сессия браузера {pid} превысила лимит ({reason}), процессы завершаются")
+                self.kill(tree, reason)
+                self.pool.discard(driver)
+                continue
+            tracked.update(process.pid for process in tree)
+            processes += len(tree)
+            rss += size
+        self.processes, self.rss = processes, rss
+        self.reap(tracked)
+        return tracked
+
+    def reap(self, tracked):
+        """
+        Добивает потерянные процессы сессий бота и собирает завершившихся потомков.
+        Процессы без каталога сессии в командной строке не трогаются
+        """
+        psutil = self.psutil
+        me = os.getpid()
+        now = time.time()
+        orphans = []
+        in_use = set()
+        for process in psutil.process_iter(["pid", "ppid", "name", "create_time", "status",
+                                            "cmdline"]):
+            info = process.info
+            if info["status"] == psutil.STATUS_ZOMBIE:
+                if info["ppid"] == me:
+                    try:
+                        process.wait(0)
+                    except psutil.Error:
+                        pass
+                continue
+            name = (info["name"] or "").lower()
+            if name not in self.DRIVER_NAMES and name not in self.BROWSER_NAMES:
+                continue
+            session = self.session_of(info["cmdline"])
+            if session is None:
+                continue
+            if info["pid"] in tracked:
+                in_use.add(session)
+            elif session.startswith(self.owner + "-"):
+                # Своя сессия вне пула (например, после зависшего quit); только что
+                # запущенная ещё может быть не видна в пуле
+                if now - (info["create_time"] or now) < self.orphan_grace:
+                    in_use.add(session)
+                else:
+                    orphans.append(process)
+            elif self.owner_alive(session):
+                # Сессия другого работающего процесса бота
+                in_use.add(session)
+            else:
+                # Осталась от упавшего прежнего запуска
+                orphans.append(process)
+        if orphans:
+            print(f"Завершаются потерянные процессы браузера: {len(orphans)}")
+            self.kill(orphans, "orphan")
+        self.clean(in_use)
+
+    def clean(self, in_use):
+        """
+        Удаляет каталоги профилей, которыми не пользуется ни один процесс
+        """
+        try:
+            entries = os.listdir(self.profile_root)
+        except OSError:
+            return
+        now = time.time()
+        for entry in entries:
+            if entry in in_use:
+                continue
+            path = os.path.join(self.profile_root, entry)
+            try:
+                # Каталог только что созданной сессии, браузер которой ещё запускается
+                if now - os.path.getmtime(path) < self.orphan_grace:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def run(self, _):
+        """
+        Задача очереди заданий: проход надзора в отдельном потоке
+        """
+        if self.psutil is None:
+            return
+        try:
+            await asyncio.to_thread(self.check)
+        except Exception as e:
+            print(f"Ошибка надзора за браузерами: {e}")
+
+
+class UserStore:
+    """
+    Интерфейс хранилища пользователей с доступом к записи по user_id.
+    Запись — словарь вида {"name": ..., "cities": [...]}
+    """
+    def get_user(self, user_id):
+        """
+        Возвращает запись пользователя или None
+        """
+        raise NotImplementedError
+
+    def put_user(self, user_id, record):
+        """
+        Сохраняет запись пользователя
+        """
+        raise NotImplementedError
+
+    def put_many(self, records):
+        """
+        Сохраняет несколько записей (пары user_id, запись) одной операцией
+        """
+        with self.transaction():
+            for user_id, record in records:
+                self.put_user(user_id, record)
+
+    def users(self):
+        """
+        Возвращает пары (user_id, запись) для всех пользователей
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self):
+        """
+        Группирует чтения и записи в одну атомарную операцию
+        """
+        yield
+
+    def add_user(self, user_id, name):
+        """
+        Регистрирует пользователя с пустыми ячейками городов.
+        Возвращает False, если пользователь уже есть
+        """
+        with self.transaction():
+            if self.get_user(user_id) is not None:
+                return False
+            self.put_user(user_id, {"name": name, "cities": ["null", "null", "null"]})
+            return True
+
+    def update_city(self, user_id, index, city):
+        """
+        Записывает город в ячейку index и возвращает прежнее значение
+        """
+        with self.transaction():
+            record = self.get_user(user_id)
+            old_city = record["cities"][index]
+            record["cities"][index] = city
+            self.put_user(user_id, record)
+            return old_city
+
+    def set_subscription(self, user_id, subscription):
+        """
+        Сохраняет подписку пользователя; None удаляет её
+        """
+        with self.transaction():
+            record = self.get_user(user_id)
+            if subscription is None:
+                record.pop("subscription", None)
+            else:
+                record["subscription"] = subscription
+            self.put_user(user_id, record)
+
+    def close(self):
+        """
+        Освобождает ресурсы хранилища
+        """
+
+
+class JsonUserStore(UserStore):
+    """
+    Старый формат: все пользователи в одном JSON файле,
+    который читается и перезаписывается целиком
+    """
+    def __init__(self, data_file=DATA_FILE):
+        self.data_file = data_file
+        self._lock = threading.RLock()
+
+    def load_data(self):
+        """
+        Загружает данные из JSON файла.
+        Возвращает пустой словарь, если файл не найден
+        """
+        try:
+            with open(self.data_file, "r", encoding="windows-1251") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def save_data(self, data):
+        """
+        Сохраняет переданные данные в JSON файл,
+        обеспечивая правильное форматирование с отступами.
+        Запись идёт во временный файл, который затем подменяет основной,
+        поэтому сбой посреди записи не обрезает user_data.json
+        """
+        tmp_file = self.data_file + ".tmp"
+        with open(tmp_file, "w", encoding="windows-1251") as file:
+            json.dump(data, file, ensure_ascii=False, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.data_file)
+
+    def get_user(self, user_id):
+        with METRICS.span("user_lookup"):
+            return self.load_data().get(user_id)
+
+    def put_user(self, user_id, record):
+        with self._lock:
+            data = self.load_data()
+            data[user_id] = record
+            self.save_data(data)
+
+    def put_many(self, records):
+        with self._lock:
+            data = self.load_data()
+            data.update(records)
+            self.save_data(data)
+
+    def users(self):
+        return list(self.load_data().items())
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield
+
+
+class SqliteUserStore(UserStore):
+    """
+    Хранилище пользователей в SQLite: одна строка на пользователя,
+    чтение и запись по первичному ключу без разбора всей базы
+    """
+    def __init__(self, db_file=USER_DB):
+        self.db_file = db_file
+        # isolation_level=None: одиночные запросы фиксируются сразу,
+        # транзакции открываются явно в transaction()
+        self._conn = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    def get_user(self, user_id):
+        with METRICS.span("user_lookup"), self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_user(self, user_id, record):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
+                (user_id, json.dumps(record, ensure_ascii=False)))
+
+    def put_many(self, records):
+        """
+        Сохраняет несколько записей одной транзакцией
+        """
+        with self.transaction():
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
+                [(user_id, json.dumps(record, ensure_ascii=False))
+                 for user_id, record in records])
+
+    def users(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        return [(user_id, json.loads(data)) for user_id, data in rows]
+
+    def count(self):
+        """
+        Число пользователей в базе
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            # Вложенные транзакции входят во внешнюю
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+            finally:
+                self._depth = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedUserStore(UserStore):
+    """
+    Профили пользователей в памяти поверх постоянного хранилища.
+    Все записи загружаются один раз при старте, чтения идут из памяти,
+    а изменённые записи сбрасываются в хранилище пачкой по таймеру и при остановке
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self._records = dict(backend.users())
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+    def get_user(self, user_id):
+        with METRICS.span("user_lookup"):
+            record = self._records.get(user_id)
+            return copy.deepcopy(record) if record is not None else None
+
+    def put_user(self, user_id, record):
+        with self._lock:
+            self._records[user_id] = copy.deepcopy(record)
+            self._dirty.add(user_id)
+
+    def users(self):
+        with self._lock:
+            return [(user_id, copy.deepcopy(record)) for user_id, record in self._records.items()]
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield
+
+    @property
+    def dirty(self):
+        """
+        Число изменённых, но ещё не сохранённых записей
+        """
+        return len(self._dirty)
+
+    def flush(self):
+        """
+        Записывает изменённые профили в хранилище одной операцией.
+        При ошибке записи профили остаются помеченными как изменённые
+        """
+        with self._lock:
+            if not self._dirty:
+                return 0
+            dirty, self._dirty = self._dirty, set()
+            records = [(user_id, copy.deepcopy(self._records[user_id])) for user_id in dirty]
+        try:
+            self.backend.put_many(records)
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        return len(records)
+
+    def close(self):
+        self.flush()
+        self.backend.close()
+
+
+def migrate_json_to_sqlite(data_file=DATA_FILE, db_file=USER_DB):
+    """
+    Переносит пользователей из JSON файла старого формата в базу SQLite.
+    Возвращает число перенесённых записей
+    """
+    records = JsonUserStore(data_file).users()
+    store = SqliteUserStore(db_file)
+    try:
+        store.put_many(records)
+    finally:
+        store.close()
+    return len(records)
+
+
+def open_user_store(shared=False):
+    """
+    Открывает хранилище, выбранное в USER_STORE: sqlite (по умолчанию) или json.
+    Пустая база SQLite при первом запуске заполняется из старого JSON файла.
+    Если USER_FLUSH_INTERVAL больше нуля, хранилище оборачивается кэшем в памяти.
+    shared — базу используют сразу несколько процессов: только SQLite и без кэша
+    """
+    data_file = os.getenv("DATA_FILE", DATA_FILE)
+    if os.getenv("USER_STORE", "sqlite") == "json":
+        if shared:
+            raise ValueError("Несколько обработчиков не могут работать с USER_STORE=json")
+        store = JsonUserStore(data_file)
+    else:
+        store = SqliteUserStore(os.getenv("USER_DB", USER_DB))
+        if store.count() == 0 and os.path.exists(data_file):
+            store.put_many(JsonUserStore(data_file).users())
+
+    if not shared and float(os.getenv("USER_FLUSH_INTERVAL", str(USER_FLUSH_INTERVAL))) > 0:
+        store = CachedUserStore(store)
+    return store
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Состояния ConversationHandler и user_data в SQLite, чтобы перезапуск
+    не обрывал диалоги. Записи компактные: JSON без пробелов, пустые user_data
+    не хранятся. Изменения копятся в памяти и пишутся одной транзакцией
+    раз в interval секунд; брошенные диалоги и данные пользователей,
+    не менявшиеся дольше ttl секунд, удаляются из базы и из памяти приложения.
+    shard — (номер, число обработчиков): загружаются только чаты своей части.
+    user_data хранится отдельно для каждой части: обновления делятся между
+    обработчиками по чату, и данные пользователя из группового чата пишет
+    и читает тот же обработчик, что обслуживает этот чат
+    """
+    def __init__(self, db_file=STATE_DB, interval=STATE_FLUSH_INTERVAL, ttl=STATE_TTL, shard=None):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=interval,
+        )
+        self.db_file = db_file
+        self.ttl = ttl
+        self.shard = shard
+        self.part = shard[0] if shard is not None else 0
+        self._conn = sqlite3.connect(
+            db_file, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_user_data(shard[1] if shard is not None else 1)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL,"
+            " state INTEGER NOT NULL, updated REAL NOT NULL, PRIMARY KEY (name, key))")
+        self._lock = threading.Lock()
+        self._users = {}  # user_id -> JSON user_data или None для удаления
+        self._conversations = {}  # (имя диалога, JSON ключа) -> состояние или None
+
+    def _create_user_data(self, parts):
+        """
+        Создаёт таблицу user_data с номером части в ключе. Таблица прежнего
+        формата переносится: данные попадают в часть личного чата пользователя
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(user_data)")]
+            if columns and "part" not in columns:
+                self._conn.execute("ALTER TABLE user_data RENAME TO user_data_old")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_data (part INTEGER NOT NULL,"
+                " user_id INTEGER NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL,"
+                " PRIMARY KEY (part, user_id))")
+            if columns and "part" not in columns:
+                self._conn.execute(
+                    "INSERT INTO user_data (part, user_id, data, updated)"
+                    " SELECT user_id % ?, user_id, data, updated FROM user_data_old", (parts,))
+                self._conn.execute("DROP TABLE user_data_old")
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    def _own(self, chat_id):
+        return self.shard is None or chat_id % self.shard[1] == self.shard[0]
+
+    async def get_user_data(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, data FROM user_data WHERE part = ? AND updated >= ?",
+                (self.part, time.time() - self.ttl)).fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    async def get_conversations(self, name):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, state FROM conversations WHERE name = ? AND updated >= ?",
+                (name, time.time() - self.ttl)).fetchall()
+        conversations = {}
+        for key, state in rows:
+            key = tuple(json.loads(key))
+            if self._own(key[0]):
+                conversations[key] = state
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        # Неблокирующие обработчики сообщают о конце диалога состоянием END, а не None
+        if new_state == ConversationHandler.END:
+            new_state = None
+        self._conversations[(name, self._dumps(list(key)))] = new_state
+
+    async def update_user_data(self, user_id, data):
+        self._users[user_id] = self._dumps(data) if data else None
+
+    async def drop_user_data(self, user_id):
+        self._users[user_id] = None
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    # Данные чатов, бота и callback_data не используются
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def save(self):
+        """
+        Записывает накопившиеся изменения одной транзакцией
+        """
+        users, self._users = self._users, {}
+        conversations, self._conversations = self._conversations, {}
+        if not users and not conversations:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO user_data (part, user_id, data, updated)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(self.part, user_id, data, now)
+                     for user_id, data in users.items() if data is not None])
+                self._conn.executemany(
+                    "DELETE FROM user_data WHERE part = ? AND user_id = ?",
+                    [(self.part, user_id) for user_id, data in users.items() if data is None])
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO conversations (name, key, state, updated)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(name, key, state, now)
+                     for (name, key), state in conversations.items() if state is not None])
+                self._conn.executemany(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    [(name, key) for (name, key), state in conversations.items() if state is None])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                # Изменения, пришедшие во время записи, новее возвращаемых
+                for user_id, data in users.items():
+                    self._users.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._conversations.setdefault(key, state)
+                raise
+
+    async def flush(self):
+        self.save()
+
+    def expire(self):
+        """
+        Удаляет из базы просроченные диалоги и user_data (всех частей, в том числе
+        оставшихся после уменьшения числа обработчиков).
+        Возвращает идентификаторы пользователей своей части с удалёнными данными
+        """
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT user_id FROM user_data WHERE part = ? AND updated < ?",
+                (self.part, cutoff))]
+            self._conn.execute("DELETE FROM user_data WHERE updated < ?", (cutoff,))
+            self._conn.execute("DELETE FROM conversations WHERE updated < ?", (cutoff,))
+        return expired
+
+    async def run(self, context):
+        """
+        Задача очереди заданий: сохраняет изменения, удаляет просроченные записи
+        и освобождает память приложения от их user_data и от пустых user_data
+        """
+        try:
+            self.save()
+            expired = set(self.expire())
+        except Exception as e:
+            print(f"Ошибка сохранения состояний диалогов: {e}")
+            return
+        application = context.application
+        for user_id, data in list(application.user_data.items()):
+            if user_id in expired or not data:
+                application.drop_user_data(user_id)
+
+    def close(self):
+        """
+        Закрывает соединение с базой
+        """
+        with self._lock:
+            self._conn.close()
+
+
+class SettingsHandler:
+    """
+    Класс для обработки настроек пользователей:
+    регистрация и настройка сохранённых городов
+    """
+    def __init__(self, store, prewarmer=None):
+        """
+        Принимает хранилище пользователей, общее для всех обработчиков,
+        и прогрев кэша, которому сообщается о смене сохранённых городов
+        """
+        self.store = store
+        self.prewarmer = prewarmer
+
+    async def start(self, update: Update, _):
+        """
+        Инициализация пользователя при вызове команды /start
+        """
+        user_id = str(update.effective_user.id)
+        user_name = update.effective_user.first_name
+
+        if self.store.add_user(user_id, user_name):
+            await update.message.reply_text(
+                f"Привет, {user_name}! Вы добавлены в систему.\n"
+                + "Команда /weather для погоды, а /settings для настройки городов."
+            )
+        else:
+            await update.message.reply_text(
+                "Вы уже зарегистрированы!\n"
+                + "Команда /weather для погоды,"
+                + " а /settings для настройки городов."
+            )
+
+    async def settings(self, update: Update, _):
+        """
+        Выбор города для изменения
+        """
+        user_id = str(update.effective_user.id)
+        record = self.store.get_user(user_id)
+
+        if record is None:
+            await update.message.reply_text("Сначала используйте команду /start.")
+            return ConversationHandler.END
+
+        cities = record["cities"]
+        keyboard = [[KeyboardButton(cities[i])] for i in range(3)]
+        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+        await update.message.reply_text("Выберите ячейку для изменения:", reply_markup=reply_markup)
+        return 1
+
+    async def set_city(self, update: Update, context):
+        """
+        Обработка изменения города
+        """
+        user_id = str(update.effective_user.id)
+        record = self.store.get_user(user_id)
+
+        if record is None:
+            await update.message.reply_text("Сначала используйте команду /start.")
+            return ConversationHandler.END
+
+        user_message = update.message.text
+        for i in range(3):
+            if record["cities"][i] == user_message:
+                context.user_data["city_index"] = i
+                await update.message.reply_text("Введите название нового города:")
+                return 2
+
+        await update.message.reply_text("Произошла ошибка. Попробуйте ещё раз.")
+        return ConversationHandler.END
+
+    async def save_city(self, update: Update, context):
+        """
+        Сохранение нового города
+        """
+        user_id = str(update.effective_user.id)
+        city_index = context.user_data.get("city_index")
+
+        if city_index is None:
+            await update.message.reply_text("Произошла ошибка. Попробуйте ещё раз.")
+            return ConversationHandler.END
+
+        # Диалог закончен: номер ячейки больше не нужен и не должен занимать место в user_data
+        context.user_data.pop("city_index", None)
+        new_city = update.message.text
+        old_city = self.store.update_city(user_id, city_index, new_city)
+        if self.prewarmer is not None:
+            self.prewarmer.replace_saved(old_city, new_city)
+
+        await update.message.reply_text(
+            f"В ячейку с номером {city_index+1} "
+            + f"был записан {new_city} вместо {old_city}."
+            )
+        return ConversationHandler.END
+
+class ScrapeExecutor:
+    """
+    Выполняет блокирующий парсинг в пуле потоков, не останавливая цикл событий бота.
+    Число ожидающих задач ограничено, у каждого запроса свой таймаут,
+    а отменённый запрос прерывается между шагами парсинга
+    """
+    def __init__(self, workers, queue_size=SCRAPE_QUEUE_SIZE, timeout=SCRAPE_TIMEOUT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scrape")
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _done(self, _):
+        """
+        Освобождает место в очереди, когда задача завершена или снята
+        """
+        with self._lock:
+            self._pending -= 1
+
+    @property
+    def pending(self):
+        """
+        Число задач в очереди и в работе
+        """
+        return self._pending
+
+    async def run(self, func, *args, timeout=None):
+        """
+        Запускает func(cancel, *args) в пуле потоков и ждёт результат.
+        По таймауту или при отмене выставляет cancel, чтобы задача прервалась
+        """
+        with self._lock:
+            if self._pending >= self.queue_size:
+                raise ScrapeQueueFull("Очередь парсинга переполнена")
+            self._pending += 1
+
+        cancel = threading.Event()
+        future = self._executor.submit(func, cancel, *args)
+        future.add_done_callback(self._done)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Ещё не начатая задача снимается из очереди, начатая прервётся на следующем шаге
+            future.cancel()
+            cancel.set()
+            raise
+
+    def shutdown(self):
+        """
+        Снимает ожидающие задачи и останавливает пул потоков
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class WeatherProvider:
+    """
+    Интерфейс источника погоды
+    """
+    name = ""
+
+    async def fetch(self, city):
+        """
+        Возвращает WeatherResult для города
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """
+        Освобождает соединения и процессы источника
+        """
+
+
+class YandexProvider(WeatherProvider):
+    """
+    Погода с yandex.ru/pogoda: HTTP-запросы, а при неудачном разборе
+    страницы — headless Chrome из пула через очередь парсинга
+    """
+    name = "yandex"
+
+    def __init__(self):
+        """
+        Настраивает профиль загрузки ресурсов, пул сессий, очередь парсинга
+        и HTTP-клиент. Сам браузер и Selenium готовятся только при первом запуске
+        """
+        self.profile = self.browser_profile(os.getenv("BROWSER_PROFILE", BROWSER_PROFILE))
+        self.chrome_options = None
+        self.service_class = None
+        self._browser_lock = threading.Lock()
+
+        self.pool = ChromePool(
+            self.launch_browser,
+            size=int(os.getenv("CHROME_POOL_SIZE", str(CHROME_POOL_SIZE))),
+            max_uses=int(os.getenv("CHROME_MAX_USES", str(CHROME_MAX_USES))),
+            blocked_urls=self.profile["blocked_urls"],
+        )
+        self.executor = ScrapeExecutor(
+            self.pool.size,
+            queue_size=int(os.getenv("SCRAPE_QUEUE_SIZE", str(SCRAPE_QUEUE_SIZE))),
+            timeout=float(os.getenv("SCRAPE_TIMEOUT", str(SCRAPE_TIMEOUT))),
+        )
+        self.urls = ForecastUrlIndex(os.getenv("YANDEX_URL_DB", YANDEX_URL_DB),
+                                     os.getenv("YANDEX_URL_FILE", YANDEX_URL_FILE))
+        self.http = YandexHttpFetcher(os.getenv("YANDEX_URL", YANDEX_URL), self.urls)
+        self.http_breaker = CircuitBreaker.for_upstream("yandex-http")
+        self.supervisor = ChromeSupervisor(
+            self.pool,
+            rss_budget=int(os.getenv("CHROME_RSS_BUDGET", str(CHROME_RSS_BUDGET))),
+            session_budget=float(os.getenv("CHROME_SESSION_BUDGET", str(CHROME_SESSION_BUDGET))),
+            orphan_grace=float(os.getenv("CHROME_ORPHAN_GRACE", str(CHROME_ORPHAN_GRACE))),
+            profile_root=os.getenv("CHROME_PROFILE_ROOT", CHROME_PROFILE_ROOT),
+        )
+        self.browser_breaker = CircuitBreaker.for_upstream("yandex-browser")
+
+        METRICS.gauge("chrome_pool_size", lambda: self.pool.stats()["size"])
+        METRICS.gauge("chrome_pool_alive", lambda: self.pool.stats()["alive"])
+        METRICS.gauge("chrome_pool_idle", lambda: self.pool.stats()["idle"])
+        METRICS.gauge("scrape_queue_pending", lambda: self.executor.pending)
+        METRICS.gauge("chrome_processes", lambda: self.supervisor.processes)
+        METRICS.gauge("chrome_rss_bytes", lambda: self.supervisor.rss)
+
+    def browser_options(self):
+        """
+        Импортирует Selenium и готовит параметры Chrome для работы в безголовом режиме.
+        Выполняется один раз
+        """
+        with self._browser_lock:
+            if self.chrome_options is not None:
+                return
+            from selenium.webdriver.chrome.options import Options
+            from selenium.webdriver.chrome.service import Service
+
+            chrome_options = Options()
+            chrome_options.add_argument("--headless")
+            chrome_options.add_argument("--no-sandbox")
+            chrome_options.add_argument("--disable-dev-shm-usage")
+            chrome_options.add_argument("--disable-gpu")
+            chrome_options.add_argument("--disable-software-rasterizer")
+            chrome_options.add_argument("--ignore-certificate-errors")
+            chrome_options.add_argument("--allow-insecure-localhost")
+            chrome_options.add_argument("--disable-extensions")
+            chrome_options.page_load_strategy = self.profile["page_load_strategy"]
+            if self.profile["prefs"]:
+                chrome_options.add_experimental_option("prefs", self.profile["prefs"])
+
+            self.service_class = Service
+            self.chrome_options = chrome_options
+
+    def launch_browser(self):
+        """
+        Запускает новую сессию Chrome со своим chromedriver и каталогом профиля,
+        по которому надзор узнаёт процессы сессии
+        """
+        from selenium import webdriver
+
+        self.browser_options()
+        profile = self.supervisor.session_dir()
+        options = copy.deepcopy(self.chrome_options)
+        options.add_argument(f"--user-data-dir={profile}")
+        service = self.service_class('C://chromedriver/chromedriver.exe',
+                                     log_output=os.path.join(profile, "chromedriver.log"))
+        return webdriver.Chrome(service=service, options=options)
+
+    async def warmup(self, mode=BROWSER_WARMUP):
+        """
+        Фоновый прогрев после старта бота: импорт Selenium и, для mode="launch",
+        запуск первой сессии браузера
+        """
+        if mode == "off":
+            return
+        try:
+            with METRICS.span("browser_warmup"):
+                if mode == "launch":
+                    await asyncio.to_thread(self.pool.warm)
+                else:
+                    await asyncio.to_thread(self.browser_options)
+        except Exception as e:
+            print(f"Ошибка прогрева браузера: {e}")
+
+    @staticmethod
+    def browser_profile(name):
+        """
+        Возвращает профиль браузера по имени. Список блокируемых адресов
+        можно заменить переменной BROWSER_BLOCKED_URLS (шаблоны через запятую)
+        """
+        if name not in BROWSER_PROFILES:
+            raise ValueError(f"Неизвестный профиль браузера: {name}")
+        profile = dict(BROWSER_PROFILES[name])
+        blocked = os.getenv("BROWSER_BLOCKED_URLS")
+        if blocked is not None:
+            profile["blocked_urls"] = [url.strip() for url in blocked.split(",") if url.strip()]
+        return profile
+
+    async def fetch(self, city):
+        """
+        Получает погоду HTTP-запросами, а браузер запускает,
+        только если страницу не удалось разобрать.
+        Оба пути защищены своими автоматами с подстраиваемым таймаутом
+        """
+        try:
+            with METRICS.span("yandex_http"):
+                temp, feels_like, condition, name_city = await self.http_breaker.call(
+                    lambda: self.http.fetch(city), ignored=(PageParseError, CityNotFound))
+        except PageParseError as e:
+            print(f"Не удалось разобрать страницу, используется браузер: {e}")
+            temp, feels_like, condition, name_city = await self.browser_breaker.call(
+                lambda: self.executor.run(self.scrape_job, city), ignored=(ScrapeQueueFull,))
+        return WeatherResult(
+            source=self.name,
+            city=name_city,
+            temp=parse_temperature(temp),
+            feels_like=parse_temperature(feels_like),
+            condition=condition,
+        )
+
+    def scrape_job(self, cancel, city):
+        """
+        Задача для пула потоков: берёт сессию из пула и парсит погоду.
+        Сначала открывает сохранённый адрес прогноза, на поиск переходит,
+        только если адреса нет или с него не удалось прочитать погоду
+        """
+        from selenium.common.exceptions import WebDriverException
+
+        deadline = float(os.getenv("SCRAPE_DEADLINE", str(SCRAPE_DEADLINE)))
+        url = self.urls.get(city)
+        with self.pool.session(timeout=self.executor.timeout) as driver:
+            if url is not None:
+                try:
+                    # Прямой заход не должен съесть весь срок, если адрес устарел
+                    return self.scrape(driver, city, cancel, deadline / 2, url=url)
+                except (TimeoutError, WebDriverException) as e:
+                    print(f"Адрес прогноза для {city} устарел: {e}")
+                    self.urls.drop(city)
+            fields = self.scrape(driver, city, cancel, deadline)
+            self.urls.put(city, driver.current_url)
+            return fields
+
+    @staticmethod
+    def scrape(driver, city, cancel=None, deadline=SCRAPE_DEADLINE, url=None):
+        """
+        Загружает страницу погоды для города в переданной сессии браузера
+        и возвращает температуру, ощущаемую температуру, условия и название города.
+        Если передан адрес прогноза url, страница поиска пропускается.
+        Все ожидания, включая загрузку страниц, делят один общий срок deadline
+        секунд; поля страницы читаются одним скриптом. Между шагами проверяет
+        флаг отмены cancel
+        """
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.common.keys import Keys
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        end = time.monotonic() + deadline
+
+        def check():
+            if cancel is not None and cancel.is_set():
+                raise ScrapeCancelled(f"Парсинг погоды для {city} отменён")
+            if time.monotonic() >= end:
+                raise TimeoutError(f"Истёк срок парсинга погоды для {city}")
+
+        def navigate(action):
+            # Загрузка страницы после get(), Enter или клика не дольше оставшегося срока
+            check()
+            driver.set_page_load_timeout(max(end - time.monotonic(), 0.1))
+            try:
+                with METRICS.span("page_load"):
+                    action()
+            except TimeoutException as e:
+                raise TimeoutError(f"Истёк срок загрузки страницы погоды для {city}") from e
+
+        def wait(selector, condition):
+            with METRICS.span("selector_wait", selector=selector):
+                return WebDriverWait(driver, max(end - time.monotonic(), 0.1)).until(condition)
+
+        def read_fields():
+            # Ждём один раз блок текущей погоды, затем читаем все поля одним скриптом
+            wait('fact__temp', EC.presence_of_element_located((By.CLASS_NAME, 'fact__temp')))
+            with METRICS.span("extract"):
+                while True:
+                    fields = driver.execute_script(EXTRACT_SCRIPT)
+                    if all(fields):
+                        return tuple(fields)
+                    check()
+                    time.sleep(0.2)
+
+        if url is not None:
+            navigate(lambda: driver.get(url))
+            return read_fields()
+
+        navigate(lambda: driver.get('https://yandex.ru/pogoda/search'))
+        check()
+
+        search_input = wait('request', EC.presence_of_element_located((By.NAME, 'request')))
+        search_input.send_keys(city)
+        navigate(lambda: search_input.send_keys(Keys.RETURN))
+
+        wait('place-list__item-name', EC.presence_of_element_located(
+            (By.CLASS_NAME, 'place-list__item-name')))
+        check()
+
+        if "pogoda" in driver.current_url and "lat" in driver.current_url:
+            pass
+        else:
+            options = driver.find_elements(By.CLASS_NAME, 'place-list__item-name')
+            if options:
+                navigate(options[0].click)
+        check()
+        return read_fields()
+
+    async def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+        await self.http.close()
+        self.urls.close()
+
+
+class GeocodeIndex(CityIndex):
+    """
+    Координаты ([широта, долгота]) уже найденных городов по нормализованному
+    названию. Переживают перезапуск бота; промахи ищутся через Nominatim
+    не чаще раза в NOMINATIM_INTERVAL секунд
+    """
+    def __init__(self, db_file=GEOCODE_DB, legacy_file=GEOCODE_FILE):
+        super().__init__(db_file, legacy_file)
+        self._lookup_lock = asyncio.Lock()
+        self._last_lookup = 0.0
+
+    async def resolve(self, city, lookup):
+        """
+        Возвращает координаты из индекса, а при промахе вызывает lookup(city)
+        с соблюдением интервала между запросами и запоминает ответ
+        """
+        coords = self.get(city)
+        if coords is not None:
+            return coords
+        async with self._lookup_lock:
+            coords = self.get(city)
+            if coords is not None:
+                return coords
+            delay = self._last_lookup + NOMINATIM_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                coords = await lookup(city)
+            finally:
+                self._last_lookup = time.monotonic()
+            if coords is not None:
+                self.put(city, coords)
+            return coords
+
+
+class OpenMeteoProvider(WeatherProvider):
+    """
+    Погода из JSON API Open-Meteo по координатам из Nominatim.
+    Запросы к Open-Meteo и Nominatim защищены отдельными автоматами
+    """
+    name = "open-meteo"
+
+    # Одновременных запросов на хост
+    HOST_CONCURRENCY = {"nominatim.openstreetmap.org": 1, "api.open-meteo.com": 10}
+
+    def __init__(self, geocoder, forecast_url=OPEN_METEO_URL, nominatim_url=NOMINATIM_URL,
+                 batch_size=OPEN_METEO_BATCH):
+        self.geocoder = geocoder
+        self.batch_size = batch_size
+        self.forecast_url = forecast_url
+        self.nominatim_url = nominatim_url
+        self.client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+        self._host_limits = {}
+        self.breakers = {
+            "open-meteo": CircuitBreaker.for_upstream("open-meteo"),
+            "nominatim": CircuitBreaker.for_upstream("nominatim"),
+        }
+
+    async def get_json(self, url, params=None, headers=None, upstream="open-meteo"):
+        """
+        GET-запрос с ограничением одновременных запросов на хост и повторами
+        сетевых сбоев, 429 и 5xx с экспоненциальной задержкой и случайным разбросом.
+        Каждая попытка идёт через автомат защиты сайта upstream
+        """
+        host = urlsplit(url).hostname
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.HOST_CONCURRENCY.get(host, 5))
+        breaker = self.breakers[upstream]
+
+        async def request():
+            response = await self.client.get(url, params=params, headers=headers)
+            # Ошибкой сайта считаются только перегрузка и сбои сервера
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            return response
+
+        for attempt in range(HTTP_RETRIES + 1):
+            try:
+                async with self._host_limits[host]:
+                    response = await breaker.call(request)
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPError as err:
+                retryable = isinstance(err, httpx.TransportError) or (
+                    isinstance(err, httpx.HTTPStatusError)
+                    and (err.response.status_code == 429 or err.response.status_code >= 500))
+                if attempt == HTTP_RETRIES or not retryable:
+                    raise
+                await asyncio.sleep(random.uniform(0, HTTP_BACKOFF * 2 ** attempt))
+        return None
+
+    async def lookup(self, city):
+        """
+        Ищет координаты города через Nominatim
+        """
+        with METRICS.span("geocode"):
+            data = await self.get_json(
+                self.nominatim_url, params={"city": city, "format": "json"},
+                headers=NOMINATIM_HEADERS, upstream="nominatim")
+        if not data:
+            return None
+        return [float(data[0]["lat"]), float(data[0]["lon"])]
+
+    async def fetch(self, city):
+        coords = await self.geocoder.resolve(city, self.lookup)
+        if coords is None:
+            raise CityNotFound(f"Город {city} не найден")
+
+        with METRICS.span("forecast"):
+            data = await self.get_json(self.forecast_url, params={
+                "latitude": coords[0],
+                "longitude": coords[1],
+                "current": "temperature_2m,apparent_temperature,weathercode",
+                "daily": "temperature_2m_max,temperature_2m_min,precipitation_sum",
+                "forecast_days": 1,
+                "timezone": "auto",
+            })
+        return self.to_result(city, data)
+
+    async def fetch_many(self, cities):
+        """
+        Погода для нескольких городов запросами к Open-Meteo по batch_size точек.
+        Для ненайденных городов и городов из неудачных пакетов в списке
+        результатов стоит None; если не удался ни один пакет, ошибка пробрасывается
+        """
+        located = []
+        for city in cities:
+            coords = await self.geocoder.resolve(city, self.lookup)
+            if coords is not None:
+                located.append((city, coords))
+        if not located:
+            return [None] * len(cities)
+
+        chunks = [located[i:i + self.batch_size]
+                  for i in range(0, len(located), self.batch_size)]
+        answers = await asyncio.gather(
+            *(self._fetch_chunk(chunk) for chunk in chunks), return_exceptions=True)
+        results = {}
+        errors = []
+        for chunk, answer in zip(chunks, answers):
+            if isinstance(answer, Exception):
+                errors.append(answer)
+                continue
+            for (city, _), item in zip(chunk, answer):
+                results[city] = self.to_result(city, item)
+        if len(errors) == len(chunks):
+            raise errors[0]
+        for error in errors:
+            print(f"Ошибка пакетного запроса Open-Meteo: {error}")
+        return [results.get(city) for city in cities]
+
+    async def _fetch_chunk(self, located):
+        """
+        Один пакетный запрос к Open-Meteo: список ответов по точкам
+        """
+        with METRICS.span("forecast", batch="yes"):
+            data = await self.get_json(self.forecast_url, params={
+                "latitude": ",".join(str(coords[0]) for _, coords in located),
+                "longitude": ",".join(str(coords[1]) for _, coords in located),
+                "current": "temperature_2m,apparent_temperature,weathercode",
+                "daily": "temperature_2m_max,temperature_2m_min,precipitation_sum",
+                "forecast_days": 1,
+                "timezone": "auto",
+            })
+        # Для одной точки API возвращает объект, для нескольких — список
+        return [data] if isinstance(data, dict) else data
+
+    def to_result(self, city, data):
+        """
+        Переводит ответ Open-Meteo в WeatherResult
+        """
+        current, daily = data["current"], data["daily"]
+        return WeatherResult(
+            source=self.name,
+            city=city,
+            temp=current["temperature_2m"],
+            feels_like=current.get("apparent_temperature"),
+            condition=WEATHER_CODES.get(current.get("weathercode"), "Неизвестные условия 🌈"),
+            temp_min=daily["temperature_2m_min"][0],
+            temp_max=daily["temperature_2m_max"][0],
+            precipitation=daily.get("precipitation_sum", [None])[0],
+        )
+
+    async def close(self):
+        await self.client.aclose()
+        self.geocoder.close()
+
+
+class ProviderStats:
+    """
+    Задержка и ошибки одного источника погоды
+    """
+    def __init__(self):
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0.0
+
+    def record_success(self, latency):
+        """
+        Учитывает успешный запрос: скользящее среднее задержки
+        """
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.failures = 0
+
+    def record_failure(self):
+        """
+        Учитывает ошибку; после нескольких подряд источник временно выключается
+        """
+        self.failures += 1
+        if self.failures >= PROVIDER_MAX_FAILURES:
+            self.down_until = time.monotonic() + PROVIDER_COOLDOWN
+
+    def healthy(self):
+        """
+        Источник не выключен после серии ошибок
+        """
+        return time.monotonic() >= self.down_until
+
+
+class ProviderRouter:
+    """
+    Выбирает самый быстрый исправный источник погоды.
+    Если он не ответил за hedge_delay секунд, параллельно запрашивается
+    следующий, и используется первый успешный ответ
+    """
+    def __init__(self, providers, cache, hedge_delay=HEDGE_DELAY,
+                 fallback_concurrency=FALLBACK_CONCURRENCY):
+        if not providers:
+            raise ValueError("Нужен хотя бы один источник погоды")
+        self.providers = providers
+        self.cache = cache
+        self.hedge_delay = hedge_delay
+        self.fallback_concurrency = fallback_concurrency
+        self.stats = {provider.name: ProviderStats() for provider in providers}
+
+    def ranked(self):
+        """
+        Источники по возрастанию задержки, исправные и без недавних ошибок впереди.
+        Ещё не опробованные идут первыми в порядке настройки, чтобы замерить каждый
+        """
+        def key(item):
+            index, provider = item
+            stats = self.stats[provider.name]
+            latency = stats.latency if stats.latency is not None else 0.0
+            return (not stats.healthy(), stats.failures, latency, index)
+        return [provider for _, provider in sorted(enumerate(self.providers), key=key)]
+
+    async def _measured(self, provider, city):
+        start = time.monotonic()
+        try:
+            result = await provider.fetch(city)
+        except (CityNotFound, CircuitOpen):
+            # Отказ автомата уже учтён: запрос до источника не дошёл
+            raise
+        except Exception:
+            self.stats[provider.name].record_failure()
+            METRICS.inc("weather_provider_errors_total", provider=provider.name)
+            raise
+        latency = time.monotonic() - start
+        self.stats[provider.name].record_success(latency)
+        METRICS.observe("weather_provider_seconds", latency, provider=provider.name)
+        return result
+
+    async def _call(self, provider, city, fresh=False):
+        load = self.cache.refresh if fresh else self.cache.get_or_fetch
+        return await load(provider.name, city, lambda: self._measured(provider, city))
+
+    def cached(self, city):
+        """
+        Свежая погода для города из кэша любого источника или None
+        """
+        for provider in self.providers:
+            cached = self.cache.get(provider.name, city)
+            if cached is not None:
+                self.cache.hits += 1
+                return cached
+        return None
+
+    def stale(self, city, max_age):
+        """
+        Погода для города из кэша любого источника, истёкшая не больше max_age секунд назад
+        """
+        for provider in self.providers:
+            cached = self.cache.get_stale(provider.name, city, max_age)
+            if cached is not None:
+                return cached
+        return None
+
+    def expires_in(self, city):
+        """
+        Сколько секунд осталось жить самой свежей записи о городе или None
+        """
+        left = [self.cache.expires_in(provider.name, city) for provider in self.providers]
+        left = [value for value in left if value is not None]
+        return max(left) if left else None
+
+    async def fetch(self, city, fresh=False):
+        """
+        Возвращает погоду из кэша любого источника или от самого быстрого из них.
+        fresh=True загружает данные заново, минуя кэш
+        """
+        if not fresh:
+            cached = self.cached(city)
+            if cached is not None:
+                return cached
+
+        order = self.ranked()
+        pending = set()
+        error = None
+        try:
+            while order or pending:
+                if order and len(pending) < 2:
+                    pending.add(asyncio.ensure_future(self._call(order.pop(0), city, fresh)))
+                # Пока есть запасной источник, ждём не дольше hedge_delay
+                timeout = self.hedge_delay if order and len(pending) < 2 else None
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    # Город не существует: другие источники его тоже не найдут
+                    if isinstance(error, CityNotFound):
+                        raise error
+        finally:
+            for task in pending:
+                task.cancel()
+        # Все источники недоступны: лучше недавние данные из кэша, чем ошибка
+        if not isinstance(error, CityNotFound):
+            stale = self.stale(city, self.cache.stale)
+            if stale is not None:
+                METRICS.inc("weather_stale_served_total")
+                return stale
+        raise error
+
+    async def fetch_many(self, cities):
+        """
+        Погода для нескольких городов. Промахи кэша сначала запрашиваются
+        пакетами у исправного источника с fetch_many, остальное — по одному городу,
+        не больше fallback_concurrency одновременно. Вместо результата может стоять исключение
+        """
+        results = {}
+        for city in cities:
+            cached = self.cached(city)
+            if cached is not None:
+                results[city] = cached
+        missing = [city for city in dict.fromkeys(cities) if city not in results]
+
+        batch = next((provider for provider in self.ranked()
+                      if hasattr(provider, "fetch_many") and self.stats[provider.name].healthy()),
+                     None)
+        if batch is not None and len(missing) > 1:
+            start = time.monotonic()
+            try:
+                fetched = await batch.fetch_many(missing)
+            except Exception as e:
+                self.stats[batch.name].record_failure()
+                print(f"Ошибка пакетного запроса {batch.name}: {e}")
+            else:
+                self.stats[batch.name].record_success(time.monotonic() - start)
+                for city, result in zip(missing, fetched):
+                    if result is not None:
+                        self.cache.put(batch.name, city, result)
+                        results[city] = result
+                missing = [city for city in missing if city not in results]
+
+        limit = asyncio.Semaphore(self.fallback_concurrency)
+
+        async def fetch_one(city):
+            async with limit:
+                return await self.fetch(city)
+
+        values = await asyncio.gather(
+            *(fetch_one(city) for city in missing), return_exceptions=True)
+        results.update(zip(missing, values))
+        return [results[city] for city in cities]
+
+    async def close(self):
+        """
+        Закрывает все источники
+        """
+        for provider in self.providers:
+            await provider.close()
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше burst в запасе
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Забирает токен, если он есть
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionController:
+    """
+    Допуск запросов погоды к источникам.
+    Повторный запрос того же города из того же чата присоединяется к уже идущему;
+    остальные ограничиваются корзинами токенов на пользователя и на весь бот.
+    Если очередь запросов к источникам (backlog()) больше shed_backlog,
+    отдаются данные из кэша, устаревшие не больше чем на stale_age секунд
+    """
+    def __init__(self, router, backlog, user_rate=USER_RATE, user_burst=USER_BURST,
+                 global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 shed_backlog=SHED_BACKLOG, stale_age=STALE_MAX_AGE, max_users=RATE_USERS_MAX):
+        self.router = router
+        self.backlog = backlog
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.shed_backlog = shed_backlog
+        self.stale_age = stale_age
+        self.max_users = max_users
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self._users = OrderedDict()
+        self._inflight = {}
+
+    def admit(self, user_id):
+        """
+        Забирает токен пользователя и общий токен, иначе поднимает RateLimited
+        """
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            # Давно не приходившие пользователи забываются: их корзины уже полны
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_id)
+        if not bucket.take():
+            METRICS.inc("admission_total", decision="user_limited")
+            raise RateLimited(f"Пользователь {user_id} превысил частоту запросов")
+        if not self.bucket.take():
+            METRICS.inc("admission_total", decision="global_limited")
+            raise RateLimited("Превышена общая частота запросов")
+
+    async def fetch(self, chat_id, user_id, city):
+        """
+        Возвращает (погода, устарела ли она) с учётом ограничений
+        """
+        key = (chat_id, normalize_city(city))
+        task = self._inflight.get(key)
+        if task is not None:
+            METRICS.inc("admission_total", decision="joined")
+            return await asyncio.shield(task)
+
+        cached = self.router.cached(city)
+        if cached is not None:
+            METRICS.inc("admission_total", decision="cached")
+            return cached, False
+
+        if self.backlog() > self.shed_backlog:
+            stale = self.router.stale(city, self.stale_age)
+            if stale is not None:
+                METRICS.inc("admission_total", decision="stale")
+                return stale, True
+
+        self.admit(user_id)
+        METRICS.inc("admission_total", decision="admitted")
+        task = asyncio.ensure_future(self._fetch(city))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, city):
+        return await self.router.fetch(city), False
+
+
+class CityPrewarmer:
+    """
+    Фоновое обновление популярных городов. Считает запросы по городам
+    и сохранённые в профилях города, и незадолго до истечения кэша
+    заново загружает погоду для самых популярных из них.
+    Редкие города забываются, число учитываемых городов ограничено max_cities.
+    Сохранённые города читаются из хранилища один раз при создании,
+    дальше их счёт ведёт save_city через replace_saved
+    """
+    def __init__(self, router, store, top_n=PREWARM_TOP_N, margin=PREWARM_MARGIN,
+                 concurrency=PREWARM_CONCURRENCY, min_weight=PREWARM_MIN_WEIGHT,
+                 max_cities=PREWARM_MAX_CITIES):
+        self.router = router
+        self.store = store
+        self.top_n = top_n
+        self.margin = margin
+        self.concurrency = concurrency
+        self.min_weight = min_weight
+        self.max_cities = max_cities
+        self.counts = Counter()
+        self._names = {}
+        self.saved = Counter()
+        self._saved_names = {}
+        for _, record in store.users():
+            for city in record.get("cities", []):
+                self.replace_saved("null", city)
+
+    def replace_saved(self, old_city, new_city):
+        """
+        Учитывает замену сохранённого в профиле города old_city на new_city
+        """
+        if old_city != "null":
+            key = normalize_city(old_city)
+            self.saved[key] -= 1
+            if self.saved[key] <= 0:
+                del self.saved[key]
+                self._saved_names.pop(key, None)
+        if new_city != "null":
+            key = normalize_city(new_city)
+            self.saved[key] += 1
+            self._saved_names.setdefault(key, new_city)
+
+    def record(self, city, weight=1.0):
+        """
+        Учитывает запрос погоды для города. Если городов уже max_cities,
+        новый вытесняет город с наименьшим весом
+        """
+        key = normalize_city(city)
+        if key not in self.counts and len(self.counts) >= self.max_cities:
+            self._forget(min(self.counts, key=self.counts.get))
+        self.counts[key] += weight
+        self._names.setdefault(key, city)
+
+    def _forget(self, key):
+        del self.counts[key]
+        self._names.pop(key, None)
+
+    def popular(self):
+        """
+        Самые популярные города с учётом сохранённых в профилях
+        """
+        # Старые запросы постепенно теряют вес, сохранённые города дают постоянную добавку
+        for key in list(self.counts):
+            self.counts[key] *= 0.5
+            if self.counts[key] < self.min_weight:
+                self._forget(key)
+        for key, count in self.saved.items():
+            self.record(self._saved_names[key], count)
+        return [self._names[key] for key, _ in self.counts.most_common(self.top_n)]
+
+    async def run(self, _):
+        """
+        Задача очереди заданий: обновляет города, кэш которых скоро истечёт
+        """
+        due = []
+        for city in self.popular():
+            left = self.router.expires_in(city)
+            if left is None or left < self.margin:
+                due.append(city)
+
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def refresh(city):
+            async with limit:
+                await self.router.fetch(city, fresh=True)
+
+        results = await asyncio.gather(*(refresh(city) for city in due), return_exceptions=True)
+        for city, result in zip(due, results):
+            if isinstance(result, Exception):
+                print(f"Ошибка прогрева {city}: {result}")
+
+
+class DeliveryQueue:
     """
-    Класс для обработки настроек пользователей,
-    включая загрузку, сохранение данных и настройку города
+    Очередь исходящих сообщений с ограничением скорости:
+    не больше rate сообщений в секунду на бота и не чаще одного сообщения
+    в chat_interval секунд в один чат
     """
-    def __init__(self):
+    def __init__(self, rate=DELIVERY_RATE, chat_interval=DELIVERY_CHAT_INTERVAL,
+                 workers=DELIVERY_WORKERS):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self._bot = None
+        self._tasks = []
+        self._next_send = 0.0
+        self._last_chat_send = {}
+        self._waiting = {}  # чат -> отложенные сообщения в этот чат по порядку
+        self._deferred = 0
+        self._lock = asyncio.Lock()
+
+    def start(self, bot):
         """
-        Инициализирует параметры Chrome для работы в безголовом режиме
-        с необходимыми настройками
-        для безопасного и оптимизированного выполнения.
+        Запускает отправляющие задачи
         """
-        self.data_file = "user_data.json"
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
 
-    def load_data(self):
+    def send(self, chat_id, text):
         """
-        Загружает данные из JSON файла. 
-        Возвращает пустой словарь, если файл не найден
+        Ставит сообщение в очередь
         """
-        try:
-            with open(self.data_file, "r", encoding="windows-1251") as file:
-                return json.load(file)
-        except FileNotFoundError:
-            return {}
+        self.queue.put_nowait((chat_id, text, False))
 
-    def save_data(self, data):
+    async def _wait_turn(self, chat_id):
         """
-        Сохраняет переданные данные в JSON файл, 
-        обеспечивая правильное форматирование с отступами
+        Ждёт своей очереди по общему лимиту бота.
+        Возвращает задержку, если в этот чат писать ещё рано
         """
-        with open(self.data_file, "w", encoding="windows-1251") as file:
-            json.dump(data, file, ensure_ascii=False, indent=4)
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            chat_delay = self._last_chat_send.get(chat_id, 0.0) + self.chat_interval - now
+            if chat_delay > 0:
+                return chat_delay
+            self._last_chat_send[chat_id] = max(now, self._next_send)
+            wait = self._next_send - now
+            self._next_send = max(now, self._next_send) + 1 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return 0
 
-    async def start(self, update: Update, _):
+    async def _worker(self):
         """
-        Инициализация пользователя при вызове команды /start
+        Отправляет сообщения из очереди. head — сообщение, выпущенное из отложенных
+        своего чата: после него выпускается следующее, так порядок в чате сохраняется
         """
-        user_id = str(update.effective_user.id)
-        user_name = update.effective_user.first_name
-        data = self.load_data()
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id, text, head = await self.queue.get()
+            try:
+                if not head and chat_id in self._waiting:
+                    # В этот чат уже ждут сообщения: новое встаёт за ними
+                    self._waiting[chat_id].append(text)
+                    self._deferred += 1
+                    continue
+                delay = await self._wait_turn(chat_id)
+                if delay > 0:
+                    # В чат писать рано: сообщение ждёт отдельно, не задерживая другие чаты
+                    self._hold(chat_id, text, delay)
+                    head = False
+                    continue
+                await self._bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                async with self._lock:
+                    self._next_send = max(self._next_send, loop.time() + retry_after)
+                self._hold(chat_id, text, retry_after)
+                head = False
+            except Forbidden:
+                # Пользователь заблокировал бота
+                pass
+            except Exception as e:
+                print(f"Ошибка отправки в чат {chat_id}: {e}")
+            finally:
+                if head:
+                    self._next(chat_id)
+                self.queue.task_done()
 
-        if user_id not in data:
-            data[user_id] = {
-                "name": user_name,
-                "cities": ["null", "null", "null"]
-            }
-            self.save_data(data)
-            await update.message.reply_text(
-                f"Привет, {user_name}! Вы добавлены в систему.\n"
-                + "Команда /weather для погоды, а /settings для настройки городов."
-            )
+    def _hold(self, chat_id, text, delay):
+        """
+        Откладывает сообщение первым в очереди своего чата на delay секунд
+        """
+        self._waiting.setdefault(chat_id, deque()).appendleft(text)
+        self._deferred += 1
+        asyncio.get_running_loop().call_later(delay, self._release, chat_id)
+
+    def _release(self, chat_id):
+        """
+        Возвращает в общую очередь первое отложенное сообщение чата
+        """
+        self._deferred -= 1
+        self.queue.put_nowait((chat_id, self._waiting[chat_id].popleft(), True))
+
+    def _next(self, chat_id):
+        """
+        После отправки выпущенного сообщения планирует следующее отложенное
+        """
+        if self._waiting.get(chat_id):
+            asyncio.get_running_loop().call_later(self.chat_interval, self._release, chat_id)
         else:
-            await update.message.reply_text(
-                "Вы уже зарегистрированы!\n"
-                + "Команда /weather для погоды,"
-                + " а /settings для настройки городов."
-            )
+            self._waiting.pop(chat_id, None)
 
-    async def settings(self, update: Update, _):
+    async def _drain(self):
+        while True:
+            await self.queue.join()
+            if not self._waiting:
+                return
+            await asyncio.sleep(self.chat_interval)
+
+    async def stop(self, timeout=5):
         """
-        Выбор города для изменения
+        Дожидается отправки очереди (не дольше timeout секунд) и останавливает задачи
         """
-        user_id = str(update.effective_user.id)
-        data = self.load_data()
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Не отправлено сообщений: {self.queue.qsize() + self._deferred}")
+        for task in self._tasks:
+            task.cancel()
 
-        if user_id not in data:
-            await update.message.reply_text("Сначала используйте команду /start.")
-            return ConversationHandler.END
 
-        cities = data[user_id]["cities"]
-        keyboard = [[KeyboardButton(cities[i])] for i in range(3)]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-        await update.message.reply_text("Выберите ячейку для изменения:", reply_markup=reply_markup)
-        return 1
+def parse_utc_offset(text):
+    """
+    Переводит смещение от UTC ("+3", "-5", "+5:30") в минуты или None
+    """
+    match = re.fullmatch(r"([+-]?)(\d{1,2})(?::(\d{2}))?", text)
+    if not match:
+        return None
+    minutes = int(match.group(2)) * 60 + int(match.group(3) or 0)
+    return -minutes if match.group(1) == "-" else minutes
 
-    async def set_city(self, update: Update, context):
+
+class SubscriptionHandler:
+    """
+    Ежедневная рассылка погоды по сохранённым городам в выбранное время.
+    Подписчики сгруппированы по минуте рассылки (UTC); в каждую минуту
+    каждый город запрашивается один раз, а сообщения уходят через DeliveryQueue.
+    Если задан shard (номер, число обработчиков), рассылка идёт только
+    пользователям своей части общей очереди
+    """
+    def __init__(self, store, router, delivery, shard=None):
+        self.store = store
+        self.router = router
+        self.delivery = delivery
+        self.slots = {}  # минута суток UTC -> множество user_id
+        self._last_slot = None
+        for user_id, record in store.users():
+            if shard is not None and int(user_id) % shard[1] != shard[0]:
+                continue
+            if "subscription" in record:
+                self._add(user_id, record["subscription"]["slot"])
+
+    def _add(self, user_id, slot):
+        self.slots.setdefault(slot, set()).add(user_id)
+
+    def _remove(self, user_id, slot):
+        subscribers = self.slots.get(slot)
+        if subscribers is not None:
+            subscribers.discard(user_id)
+            if not subscribers:
+                del self.slots[slot]
+
+    async def subscribe(self, update: Update, context):
         """
-        Обработка изменения города
+        /subscribe ЧЧ:ММ [смещение от UTC] — подписка на ежедневный прогноз
         """
         user_id = str(update.effective_user.id)
-        data = self.load_data()
+        record = self.store.get_user(user_id)
 
-        if user_id not in data:
+        if record is None:
             await update.message.reply_text("Сначала используйте команду /start.")
-            return ConversationHandler.END
+            return
 
-        user_message = update.message.text
-        for i in range(3):
-            if data[user_id]["cities"][i] == user_message:
-                context.user_data["city_index"] = i
-                await update.message.reply_text("Введите название нового города:")
-                return 2
+        args = context.args or []
+        match = re.fullmatch(r"(\d{1,2}):(\d{2})", args[0]) if args else None
+        offset = parse_utc_offset(args[1]) if len(args) > 1 else int(
+            os.getenv("DEFAULT_UTC_OFFSET", str(DEFAULT_UTC_OFFSET))) * 60
+        if (match is None or offset is None
+                or int(match.group(1)) > 23 or int(match.group(2)) > 59):
+            await update.message.reply_text(
+                "Укажите время и, при необходимости, смещение от UTC: /subscribe 08:00 +3")
+            return
 
-        await update.message.reply_text("Произошла ошибка. Попробуйте ещё раз.")
-        return ConversationHandler.END
+        hours, minutes = int(match.group(1)), int(match.group(2))
+        slot = (hours * 60 + minutes - offset) % (24 * 60)
+        old = record.get("subscription")
+        if old is not None:
+            self._remove(user_id, old["slot"])
+        self.store.set_subscription(
+            user_id, {"time": f"{hours:02d}:{minutes:02d}", "utc_offset": offset, "slot": slot})
+        self._add(user_id, slot)
+        await update.message.reply_text(
+            f"Прогноз по вашим городам будет приходить каждый день в {hours:02d}:{minutes:02d}.\n"
+            "Отменить подписку: /unsubscribe")
 
-    async def save_city(self, update: Update, context):
+    async def unsubscribe(self, update: Update, _):
         """
-        Сохранение нового города
+        /unsubscribe — отмена ежедневной рассылки
         """
         user_id = str(update.effective_user.id)
-        data = self.load_data()
-        city_index = context.user_data.get("city_index")
+        record = self.store.get_user(user_id)
 
-        if city_index is None:
-            await update.message.reply_text("Произошла ошибка. Попробуйте ещё раз.")
-            return ConversationHandler.END
+        if record is None or "subscription" not in record:
+            await update.message.reply_text("У вас нет подписки.")
+            return
 
-        new_city = update.message.text
-        old_city = data[user_id]["cities"][city_index]
-        data[user_id]["cities"][city_index] = new_city
-        self.save_data(data)
+        self._remove(user_id, record["subscription"]["slot"])
+        self.store.set_subscription(user_id, None)
+        await update.message.reply_text("Подписка отменена.")
+
+    async def run(self, _):
+        """
+        Задача очереди заданий (раз в минуту): рассылает прогноз подписчикам
+        всех минут, наступивших с прошлого запуска
+        """
+        now = datetime.now(timezone.utc)
+        slot = now.hour * 60 + now.minute
+        if self._last_slot is None:
+            self._last_slot = (slot - 1) % (24 * 60)
+        # Пропущенные из-за задержки минуты тоже обрабатываются, но не больше часа
+        missed = min((slot - self._last_slot) % (24 * 60), 60)
+        self._last_slot = slot
+        for step in range(missed - 1, -1, -1):
+            await self.deliver_slot((slot - step) % (24 * 60))
+
+    async def deliver_slot(self, slot):
+        """
+        Один раз запрашивает погоду для всех городов подписчиков минуты slot
+        и ставит сообщения в очередь отправки
+        """
+        subscribers = []
+        cities = {}
+        for user_id in list(self.slots.get(slot, ())):
+            record = self.store.get_user(user_id)
+            if record is None:
+                continue
+            user_cities = [city for city in record["cities"] if city != "null"]
+            subscribers.append((user_id, user_cities))
+            for city in user_cities:
+                cities.setdefault(normalize_city(city), city)
+        if not subscribers:
+            return
+
+        names = list(cities.values())
+        results = dict(zip(cities, await self.router.fetch_many(names)))
+        for user_id, user_cities in subscribers:
+            parts = []
+            for city in user_cities:
+                result = results[normalize_city(city)]
+                if isinstance(result, WeatherResult):
+                    parts.append(result.format())
+                else:
+                    parts.append(f"{city}: не удалось получить данные о погоде.")
+            if parts:
+                self.delivery.send(int(user_id), "Прогноз на сегодня:\n\n" + "\n\n".join(parts))
 
-        await update.message.reply_text(
-            f"В ячейку с номером {city_index+1} "
-            + f"был записан {new_city} вместо {old_city}."
-            )
-        return ConversationHandler.END
 
 class WeatherHandler:
     """
     Класс для обработки погоды:
     выбор города и получение данных о погоде
     """
-    def __init__(self):
+    def __init__(self, store):
         """
+        Настраивает кэш погоды и источники в порядке WEATHER_PROVIDERS.
+        store — общее хранилище пользователей
         """
-        self.chrome_options = Options()
-        self.chrome_options.add_argument("--headless")
-        self.chrome_options.add_argument("--no-sandbox")
-        self.chrome_options.add_argument("--disable-dev-shm-usage")
-        self.chrome_options.add_argument("--disable-gpu")
-        self.chrome_options.add_argument("--disable-software-rasterizer")
-        self.chrome_options.add_argument("--ignore-certificate-errors")
-        self.chrome_options.add_argument("--allow-insecure-localhost")
-        self.chrome_options.add_argument("--disable-extensions")
+        self.store = store
+        self.cache = WeatherCache(
+            ttl={
+                "yandex": int(os.getenv("WEATHER_TTL", str(WEATHER_TTL["yandex"]))),
+                "open-meteo": int(os.getenv("OPEN_METEO_TTL", str(WEATHER_TTL["open-meteo"]))),
+            },
+            stale=float(os.getenv("STALE_MAX_AGE", str(STALE_MAX_AGE))),
+        )
+
+        factories = {
+            "yandex": YandexProvider,
+            "open-meteo": lambda: OpenMeteoProvider(
+                GeocodeIndex(os.getenv("GEOCODE_DB", GEOCODE_DB),
+                             os.getenv("GEOCODE_FILE", GEOCODE_FILE)),
+                forecast_url=os.getenv("OPEN_METEO_URL", OPEN_METEO_URL),
+                nominatim_url=os.getenv("NOMINATIM_URL", NOMINATIM_URL),
+                batch_size=int(os.getenv("OPEN_METEO_BATCH", str(OPEN_METEO_BATCH))),
+            ),
+        }
+        names = [name.strip() for name in
+                 os.getenv("WEATHER_PROVIDERS", WEATHER_PROVIDERS).split(",") if name.strip()]
+        # Проверка до создания источников: опечатка не должна падать KeyError посреди запуска
+        if not names:
+            raise ValueError("WEATHER_PROVIDERS не задаёт ни одного источника погоды")
+        unknown = [name for name in names if name not in factories]
+        if unknown:
+            raise ValueError(f"Неизвестные источники погоды в WEATHER_PROVIDERS: {', '.join(unknown)}."
+                             + f" Доступны: {', '.join(factories)}")
+        self.router = ProviderRouter(
+            [factories[name]() for name in names],
+            self.cache,
+            hedge_delay=float(os.getenv("HEDGE_DELAY", str(HEDGE_DELAY))),
+            fallback_concurrency=int(os.getenv("FALLBACK_CONCURRENCY", str(FALLBACK_CONCURRENCY))),
+        )
+        self.prewarmer = CityPrewarmer(
+            self.router,
+            store,
+            top_n=int(os.getenv("PREWARM_TOP_N", str(PREWARM_TOP_N))),
+            margin=float(os.getenv("PREWARM_MARGIN", str(PREWARM_MARGIN))),
+            concurrency=int(os.getenv("PREWARM_CONCURRENCY", str(PREWARM_CONCURRENCY))),
+            min_weight=float(os.getenv("PREWARM_MIN_WEIGHT", str(PREWARM_MIN_WEIGHT))),
+            max_cities=int(os.getenv("PREWARM_MAX_CITIES", str(PREWARM_MAX_CITIES))),
+        )
+        self.admission = AdmissionController(
+            self.router,
+            self.backlog,
+            user_rate=float(os.getenv("USER_RATE", str(USER_RATE))),
+            user_burst=float(os.getenv("USER_BURST", str(USER_BURST))),
+            global_rate=float(os.getenv("GLOBAL_RATE", str(GLOBAL_RATE))),
+            global_burst=float(os.getenv("GLOBAL_BURST", str(GLOBAL_BURST))),
+            shed_backlog=int(os.getenv("SHED_BACKLOG", str(SHED_BACKLOG))),
+            stale_age=float(os.getenv("STALE_MAX_AGE", str(STALE_MAX_AGE))),
+        )
 
-        self.service = Service('C://chromedriver/chromedriver.exe')
+    def backlog(self):
+        """
+        Очередь запросов к источникам: выполняющиеся загрузки и задачи парсинга
+        """
+        return self.cache.inflight + sum(
+            provider.executor.pending for provider in self.router.providers
+            if isinstance(provider, YandexProvider))
 
-    async def weather(self, update: Update, _):
+    async def weather(self, update: Update, context):
         """
-        Начало процесса выбора города для отображения погоды
+        Начало процесса выбора города для отображения погоды.
+        /weather all сразу присылает погоду во всех сохранённых городах
         """
         user_id = str(update.effective_user.id)
-        data = SettingsHandler().load_data()
+        record = self.store.get_user(user_id)
 
-        if user_id not in data:
+        if record is None:
             await update.message.reply_text("Сначала используйте команду /start.")
             return ConversationHandler.END
 
-        cities = data[user_id]["cities"]
+        cities = record["cities"]
+        if context.args and context.args[0].casefold() in ("all", "все"):
+            await self.weather_all(update, [city for city in cities if city != "null"])
+            return ConversationHandler.END
+
         keyboard = [[KeyboardButton(city)] for city in cities if city != "null"]
         reply_markup = ReplyKeyboardMarkup(
             keyboard, one_time_keyboard=True, resize_keyboard=True)
         await update.message.reply_text("Выберите город:", reply_markup=reply_markup)
         return 1
 
+    async def weather_all(self, update: Update, cities):
+        """
+        Погода во всех сохранённых городах одним сообщением
+        """
+        if not cities:
+            await update.message.reply_text(
+                "Нет сохранённых городов. Добавьте их командой /settings.")
+            return
+
+        if any(self.router.cached(city) is None for city in cities):
+            try:
+                self.admission.admit(update.effective_user.id)
+            except RateLimited:
+                await update.message.reply_text(
+                    "Слишком много запросов. Подождите немного и попробуйте снова.")
+                return
+        with METRICS.span("weather_request", batch="yes"):
+            results = await self.router.fetch_many(cities)
+        parts = []
+        for city, result in zip(cities, results):
+            if isinstance(result, WeatherResult):
+                self.prewarmer.record(city)
+                parts.append(result.format())
+            elif isinstance(result, CityNotFound):
+                parts.append(f"{city}: город не найден.")
+            else:
+                parts.append(f"{city}: не удалось получить данные о погоде.")
+                print(f"Ошибка: {result}")
+        with METRICS.span("reply_send"):
+            await update.message.reply_text("\n\n".join(parts))
+
     async def fetch_weather(self, update: Update, _):
         """
         Получение погоды для выбранного города
         """
         city = update.message.text
-        driver = webdriver.Chrome(service=self.service, options=self.chrome_options)
 
         try:
-            url = 'https://yandex.ru/pogoda/search'
-            driver.get(url)
-
-            search_input = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.NAME, 'request'))
-            )
-            search_input.send_keys(city)
-            search_input.send_keys(Keys.RETURN)
-
-            WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.CLASS_NAME, 'place-list__item-name'))
-            )
-
-            if "pogoda" in driver.current_url and "lat" in driver.current_url:
-                pass
-            else:
-                options = WebDriverWait(driver, 10).until(
-                    EC.presence_of_all_elements_located(
-                        (By.CLASS_NAME, 'place-list__item-name')
-                        )
-                )
-                if options:
-                    options[0].click()
-
-            temp = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.CLASS_NAME, 'fact__temp'))
-            ).text
-            feels_like = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located(
-                    (By.CSS_SELECTOR, '.fact__feels-like .temp__value')
-                    )
-            ).text
-            condition = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located(
-                    (By.CLASS_NAME, 'link__condition')
-                    )
-            ).text
-            name_city = WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located(
-                (By.CSS_SELECTOR, '.title.title_level_1.header-title__title')
-                )
-            ).text
+            with METRICS.span("weather_request"):
+                result, stale = await self.admission.fetch(
+                    update.effective_chat.id, update.effective_user.id, city)
+            # В рейтинг попадают только пропущенные запросы к существующим городам
+            self.prewarmer.record(city)
+            text = result.format()
+            if stale:
+                text += "\n\nСейчас много запросов, показаны недавние данные."
+            with METRICS.span("reply_send"):
+                await update.message.reply_text(text)
+        except RateLimited:
             await update.message.reply_text(
-                f"Текущая температура в {name_city}: {temp}°C\n"
-                f"Ощущается как: {feels_like}°C\nУсловия: {condition}"
-            )
+                "Слишком много запросов. Подождите немного и попробуйте снова.")
+        except CityNotFound:
+            await update.message.reply_text("Город не найден. Попробуйте другой.")
+        except ScrapeQueueFull:
+            await update.message.reply_text(
+                "Сейчас слишком много запросов. Попробуйте чуть позже.")
+        except CircuitOpen:
+            await update.message.reply_text(
+                "Сайт погоды временно недоступен. Попробуйте через минуту.")
+        except asyncio.TimeoutError:
+            await update.message.reply_text(
+                "Сайт погоды отвечает слишком долго. Попробуйте ещё раз позже.")
         except Exception as e:
             await update.message.reply_text(
                 "Произошла ошибка при получении данных"
                  + " о погоде или город не найден."
                 )
             print(f"Ошибка: {e}")
-        finally:
-            driver.quit()
         return ConversationHandler.END
 
-def main():
+
+# Этапы запуска: (название, секунды от запуска процесса, показание perf_counter)
+STARTUP_STAGES = []
+
+
+def process_age():
     """
-    Основная функция
+    Сколько секунд назад создан текущий процесс, по обычным часам.
+    Требует psutil; без него возвращает процессорное время процесса —
+    грубую нижнюю оценку, не учитывающую ожидание ввода-вывода
+    """
+    try:
+        import psutil
+    except ImportError:
+        return time.process_time()
+    try:
+        started = psutil.Process().create_time()
+        if hasattr(time, "CLOCK_BOOTTIME"):
+            # На Linux create_time отсчитывается от времени загрузки, округлённого
+            # до секунды; от загрузки же по монотонным часам погрешность — доли тика
+            return max(time.clock_gettime(time.CLOCK_BOOTTIME)
+                       - (started - psutil.boot_time()), 0.0)
+        return max(time.time() - started, 0.0)
+    except psutil.Error:
+        return time.process_time()
+
+
+def startup_mark(stage):
+    """
+    Отмечает окончание этапа запуска. Первый этап (запуск интерпретатора
+    и импорты) отсчитывается от создания процесса, следующие — от него
+    по тем же обычным часам
+    """
+    now = time.perf_counter()
+    if STARTUP_STAGES:
+        _, first, clock = STARTUP_STAGES[0]
+        STARTUP_STAGES.append((stage, first + now - clock, now))
+    else:
+        STARTUP_STAGES.append((stage, process_age(), now))
+
+
+def startup_report():
+    """
+    Печатает длительность этапов запуска и отдаёт общее время старта в метрики
+    """
+    parts = []
+    previous = 0.0
+    for stage, elapsed, _ in STARTUP_STAGES:
+        parts.append(f"{stage} {elapsed - previous:.2f} с")
+        previous = elapsed
+    METRICS.gauge("startup_seconds", lambda: previous)
+    print(f"Бот готов к работе через {previous:.2f} с: " + ", ".join(parts))
+
+
+class WebhookServer:
+    """
+    Локальный асинхронный HTTP-сервер для вебхука Telegram.
+    Принимает POST с обновлением, проверяет секретный токен и передаёт JSON
+    обновления в deliver(data); отвечает сразу, не дожидаясь обработки.
+    Без секрета сервер не создаётся: иначе обновления мог бы прислать кто угодно
     """
+    def __init__(self, deliver, path=WEBHOOK_PATH, secret=None, max_body=WEBHOOK_MAX_BODY):
+        if not secret:
+            raise ValueError("Для вебхука нужен секретный токен WEBHOOK_SECRET")
+        self.deliver = deliver
+        self.path = path
+        self.secret = secret
+        self.max_body = max_body
+        self._server = None
+        self._connections = {}  # задача соединения -> writer
+        self._busy = set()  # соединения, которые сейчас обрабатывают запрос
+
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        """
+        Начинает принимать соединения
+        """
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """
+        Перестаёт принимать соединения и дожидается уже начатых запросов.
+        Простаивающие keep-alive соединения закрываются сразу
+        """
+        if self._server is None:
+            return
+        self._server.close()
+        for task, writer in list(self._connections.items()):
+            if task not in self._busy:
+                writer.close()
+        if self._connections:
+            _, pending = await asyncio.wait(list(self._connections), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        await self._server.wait_closed()
+
+    def check_secret(self, headers):
+        """
+        Сравнивает секрет из заголовка с настроенным, не раскрывая его по времени ответа
+        """
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        return hmac.compare_digest(token.encode(), self.secret.encode())
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                self._busy.add(task)
+                parts = request.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0) or 0)
+                if length > self.max_body:
+                    status = "413 Payload Too Large"
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status = await self.route(parts, headers, body)
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode())
+                await writer.drain()
+                self._busy.discard(task)
+                if not keep_alive or self._server is None or not self._server.is_serving():
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Запрос не уложился в срок остановки сервера
+            print("Соединение вебхука закрыто при остановке")
+        finally:
+            self._connections.pop(task, None)
+            self._busy.discard(task)
+            writer.close()
+
+    async def route(self, parts, headers, body):
+        """
+        Проверяет запрос и передаёт обновление дальше, возвращает статус ответа
+        """
+        if len(parts) < 2 or parts[1] != self.path:
+            return "404 Not Found"
+        if parts[0] != "POST":
+            return "405 Method Not Allowed"
+        if not self.check_secret(headers):
+            METRICS.inc("webhook_rejected_total", reason="secret")
+            return "403 Forbidden"
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict) or "update_id" not in data:
+                raise ValueError("нет update_id")
+        except ValueError as e:
+            print(f"Ошибка разбора обновления: {e}")
+            METRICS.inc("webhook_rejected_total", reason="payload")
+            return "400 Bad Request"
+        METRICS.inc("webhook_updates_total")
+        try:
+            await self.deliver(data)
+        except (KeyError, TypeError, ValueError) as e:
+            # Обновление не разбирается: повтор его не исправит
+            print(f"Ошибка разбора обновления {data.get('update_id')}: {e!r}")
+            METRICS.inc("webhook_rejected_total", reason="payload")
+            return "400 Bad Request"
+        except Exception as e:
+            print(f"Ошибка приёма обновления {data.get('update_id')}: {e!r}")
+            METRICS.inc("webhook_rejected_total", reason="deliver")
+            return "500 Internal Server Error"
+        return "200 OK"
+
+
+def update_chat_id(data):
+    """
+    Идентификатор чата из JSON обновления (или отправителя, если чата нет), иначе 0
+    """
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+class UpdateQueue:
+    """
+    Общая очередь обновлений в SQLite между приёмником вебхука и обработчиками.
+    Обновления делятся на partitions частей по чату: все сообщения одного чата
+    достаются одному обработчику и обрабатываются по порядку.
+    Запись удаляется только после обработки, включая неблокирующие обработчики,
+    так что упавший обработчик после перезапуска повторит незавершённые обновления
+    """
+    def __init__(self, db_file=UPDATE_QUEUE_DB, partitions=WORKER_COUNT):
+        self.db_file = db_file
+        self.partitions = partitions
+        self._conn = sqlite3.connect(
+            db_file, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS updates (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " part INTEGER NOT NULL, data TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS updates_part ON updates (part, id)")
+        self._lock = threading.Lock()
+
+    def partition(self, chat_id):
+        """
+        Номер обработчика для чата
+        """
+        return chat_id % self.partitions
+
+    async def put(self, data):
+        """
+        Добавляет обновление в часть его чата
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO updates (part, data) VALUES (?, ?)",
+                (self.partition(update_chat_id(data)), json.dumps(data, ensure_ascii=False)))
+
+    def take(self, part, limit=WORKER_BATCH):
+        """
+        Первые необработанные обновления части: список (id, JSON обновления)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, data FROM updates WHERE part = ? ORDER BY id LIMIT ?",
+                (part, limit)).fetchall()
+        return [(row_id, json.loads(data)) for row_id, data in rows]
+
+    def done(self, ids):
+        """
+        Удаляет обработанные обновления
+        """
+        with self._lock:
+            self._conn.executemany("DELETE FROM updates WHERE id = ?", [(i,) for i in ids])
+
+    def pending(self, part=None):
+        """
+        Число ждущих обработки обновлений, всего или в части
+        """
+        with self._lock:
+            if part is None:
+                return self._conn.execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM updates WHERE part = ?", (part,)).fetchone()[0]
+
+    def close(self):
+        """
+        Закрывает соединение с базой очереди
+        """
+        with self._lock:
+            self._conn.close()
+
+
+def stop_signal():
+    """
+    Событие, которое устанавливается по SIGINT/SIGTERM
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # В Windows обработчики сигналов в цикле событий недоступны — остаётся Ctrl+C
+            pass
+    return stop
+
+
+@asynccontextmanager
+async def running(application):
+    """
+    Запускает приложение без собственного получения обновлений, а по выходу
+    дожидается очереди обновлений и фоновых обработчиков и останавливает его
+    """
+    drain_timeout = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", str(WEBHOOK_DRAIN_TIMEOUT)))
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            yield application
+        finally:
+            if application.running:
+                await asyncio.wait_for(application.stop(), drain_timeout)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def serve_webhook(deliver, bot):
+    """
+    Принимает обновления на вебхук и передаёт их в deliver(data) до SIGINT/SIGTERM,
+    затем перестаёт принимать соединения и дожидается уже начатых запросов
+    """
+    server = WebhookServer(
+        deliver,
+        path=os.getenv("WEBHOOK_PATH", WEBHOOK_PATH),
+        secret=os.getenv("WEBHOOK_SECRET"),
+        max_body=int(os.getenv("WEBHOOK_MAX_BODY", str(WEBHOOK_MAX_BODY))),
+    )
+    stop = stop_signal()
+    port = await server.start(os.getenv("WEBHOOK_LISTEN", WEBHOOK_LISTEN),
+                              int(os.getenv("WEBHOOK_PORT", str(WEBHOOK_PORT))))
+    print(f"Вебхук слушает порт {port}")
+    try:
+        if os.getenv("WEBHOOK_URL"):
+            await bot.set_webhook(
+                os.getenv("WEBHOOK_URL"),
+                secret_token=os.getenv("WEBHOOK_SECRET"),
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await stop.wait()
+    finally:
+        await server.stop(float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", str(WEBHOOK_DRAIN_TIMEOUT))))
+
+
+async def run_webhook(application):
+    """
+    Запускает бота в режиме вебхука на собственном HTTP-сервере.
+    По SIGINT/SIGTERM перестаёт принимать обновления, дорабатывает принятые
+    и только затем останавливает приложение
+    """
+    async def deliver(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    async with running(application):
+        await serve_webhook(deliver, application.bot)
+
+
+def open_update_queue():
+    """
+    Открывает общую очередь обновлений по UPDATE_QUEUE_DB и WORKER_COUNT
+    """
+    return UpdateQueue(os.getenv("UPDATE_QUEUE_DB", UPDATE_QUEUE_DB),
+                       int(os.getenv("WORKER_COUNT", str(WORKER_COUNT))))
+
+
+async def run_ingress():
+    """
+    Приёмник (BOT_MODE=ingress): принимает вебхук и только складывает обновления
+    в общую очередь, обработкой занимаются процессы-обработчики
+    """
+    queue = open_update_queue()
+    METRICS.gauge("update_queue_pending", queue.pending)
+    metrics_port = int(os.getenv("METRICS_PORT", str(METRICS_PORT)))
+    if metrics_port:
+        await METRICS.serve(os.getenv("METRICS_HOST", METRICS_HOST), metrics_port)
+    bot = Bot(os.getenv("TOKEN"), base_url=os.getenv("TELEGRAM_API_URL") or None)
+    try:
+        async with bot:
+            await serve_webhook(queue.put, bot)
+    finally:
+        await METRICS.stop()
+        queue.close()
+
+
+async def process_batch(application, rows):
+    """
+    Обрабатывает пачку обновлений по порядку и дожидается их неблокирующих
+    обработчиков (block=False), которые продолжают работу в своих задачах.
+    Учитываются только задачи, запущенные через application.create_task за время
+    пачки; фоновые задания очереди заданий подтверждение не задерживают
+    """
+    tasks = []
+    create_task = application.create_task
+
+    def tracked(*args, **kwargs):
+        task = create_task(*args, **kwargs)
+        tasks.append(task)
+        return task
+
+    application.create_task = tracked
+    try:
+        for _, data in rows:
+            try:
+                await application.process_update(Update.de_json(data, application.bot))
+            except Exception as e:
+                print(f"Ошибка обработки обновления {data.get('update_id')}: {e}")
+        # Обработчик может сам запустить следующую задачу, поэтому ждём до конца цепочки
+        waited = 0
+        while waited < len(tasks):
+            pending, waited = tasks[waited:], len(tasks)
+            await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        del application.create_task
+
+
+async def run_worker(application, worker_id, shutdown=None):
+    """
+    Обработчик (BOT_MODE=worker): забирает обновления своей части общей очереди
+    и обрабатывает их по порядку до SIGINT/SIGTERM. Обновления удаляются
+    из очереди только после завершения всех их обработчиков: после сбоя
+    незавершённые обновления обработаются повторно.
+    В режиме cluster вместо сигналов останавливается по событию shutdown
+    от главного процесса, перед этим доработав свою часть очереди
+    """
+    queue = open_update_queue()
+    batch = int(os.getenv("WORKER_BATCH", str(WORKER_BATCH)))
+    interval = float(os.getenv("WORKER_POLL_INTERVAL", str(WORKER_POLL_INTERVAL)))
+    METRICS.gauge("update_queue_pending", lambda: queue.pending(worker_id))
+    stop = stop_signal() if shutdown is None else None
+    try:
+        async with running(application):
+            while stop is None or not stop.is_set():
+                rows = queue.take(worker_id, batch)
+                if not rows:
+                    if shutdown is not None and shutdown.is_set():
+                        break
+                    await asyncio.sleep(interval)
+                    continue
+                await process_batch(application, rows)
+                queue.done([row_id for row_id, _ in rows])
+    finally:
+        queue.close()
+
+
+def worker_process(worker_id, shutdown=None):
+    """
+    Точка входа процесса-обработчика. В режиме cluster Ctrl+C получает вся группа
+    процессов, поэтому обработчик его игнорирует и ждёт события shutdown
+    """
+    # Запуск считается от создания этого процесса: при fork отметки родителя
+    # унаследованы, при spawn модуль импортирован без вызова main()
+    STARTUP_STAGES.clear()
+    startup_mark("импорт")
     load_dotenv()
-    application = Application.builder().token(os.getenv("TOKEN")).build()
+    count = int(os.getenv("WORKER_COUNT", str(WORKER_COUNT)))
+    if shutdown is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(run_worker(build_application((worker_id, count)), worker_id, shutdown))
+    except KeyboardInterrupt:
+        pass
 
 
-    # Создаём объект SettingsHandler
-    settings_handler = SettingsHandler()
+def run_cluster():
+    """
+    Приёмник и WORKER_COUNT процессов-обработчиков на одной машине (BOT_MODE=cluster).
+    По остановке приёмника обработчики дорабатывают свои части очереди и завершаются;
+    не успевшие за WORKER_DRAIN_TIMEOUT секунд завершаются принудительно,
+    их необработанные обновления остаются в очереди до следующего запуска
+    """
+    count = int(os.getenv("WORKER_COUNT", str(WORKER_COUNT)))
+    drain_timeout = float(os.getenv("WORKER_DRAIN_TIMEOUT", str(WORKER_DRAIN_TIMEOUT)))
+    # Таблица очереди создаётся до запуска процессов
+    open_update_queue().close()
+    shutdown = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=worker_process, args=(worker_id, shutdown))
+               for worker_id in range(count)]
+    for worker in workers:
+        worker.start()
+    try:
+        asyncio.run(run_ingress())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown.set()
+        deadline = time.monotonic() + drain_timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        for worker in workers:
+            if worker.is_alive():
+                print(f"Обработчик {worker.pid} не доработал очередь, завершается принудительно")
+                worker.terminate()
+                worker.join()
+
+
+def build_application(shard=None):
+    """
+    Создаёт приложение бота со всеми обработчиками и фоновыми задачами.
+    Настройки читаются из переменных окружения.
+    shard — (номер, число обработчиков) для процесса-обработчика общей очереди:
+    профили тогда читаются из общей базы без кэша в памяти,
+    а рассылка идёт только подписчикам своей части
+    """
+    # Общее хранилище пользователей
+    store = open_user_store(shared=shard is not None)
 
     # Создаём объект WeatherHandler
-    weather_handler = WeatherHandler()
+    weather_handler = WeatherHandler(store)
+
+    # Создаём объект SettingsHandler
+    settings_handler = SettingsHandler(store, weather_handler.prewarmer)
+
+    # Подписки на ежедневный прогноз и очередь их отправки
+    delivery = DeliveryQueue(
+        rate=float(os.getenv("DELIVERY_RATE", str(DELIVERY_RATE))),
+        chat_interval=float(os.getenv("DELIVERY_CHAT_INTERVAL", str(DELIVERY_CHAT_INTERVAL))),
+    )
+    subscription_handler = SubscriptionHandler(store, weather_handler.router, delivery, shard)
+
+    # Состояния диалогов и user_data переживают перезапуск
+    persistence = SqlitePersistence(
+        os.getenv("STATE_DB", STATE_DB),
+        interval=float(os.getenv("STATE_FLUSH_INTERVAL", str(STATE_FLUSH_INTERVAL))),
+        ttl=float(os.getenv("STATE_TTL", str(STATE_TTL))),
+        shard=shard,
+    )
+
+    # Показатели кэша и очередей; пул браузеров регистрирует свои в YandexProvider
+    cache = weather_handler.cache
+    METRICS.gauge("weather_cache_hits_total", lambda: cache.hits)
+    METRICS.gauge("weather_cache_misses_total", lambda: cache.misses)
+    METRICS.gauge("weather_cache_hit_ratio",
+                  lambda: cache.hits / max(cache.hits + cache.misses, 1))
+    METRICS.gauge("weather_cache_entries", lambda: len(cache))
+    METRICS.gauge("weather_cache_bytes", lambda: cache.memory)
+    METRICS.gauge("delivery_queue_size", delivery.queue.qsize)
+    METRICS.gauge("weather_backlog", weather_handler.backlog)
+
+    # Задачи фонового прогрева браузера: ссылки держатся до их завершения
+    warmups = []
+
+    async def on_startup(app):
+        """
+        Запускает очередь отправки сообщений и HTTP-сервер метрик
+        """
+        delivery.start(app.bot)
+        metrics_port = int(os.getenv("METRICS_PORT", str(METRICS_PORT)))
+        if metrics_port:
+            # Порт METRICS_PORT занят приёмником, обработчики слушают следующие
+            if shard is not None:
+                metrics_port += 1 + shard[0]
+            await METRICS.serve(os.getenv("METRICS_HOST", METRICS_HOST), metrics_port)
+
+        # Браузер прогревается в фоне, /start и /settings уже обслуживаются
+        for provider in weather_handler.router.providers:
+            if isinstance(provider, YandexProvider):
+                warmups.append(asyncio.create_task(
+                    provider.warmup(os.getenv("BROWSER_WARMUP", BROWSER_WARMUP))))
+        startup_mark("инициализация")
+        startup_report()
+
+    async def on_shutdown(_):
+        """
+        Дожидается отправки очереди сообщений, закрывает источники погоды
+        (очередь парсинга, браузеры, HTTP-клиенты) и сохраняет профили пользователей
+        """
+        await delivery.stop()
+        await METRICS.stop()
+        await weather_handler.router.close()
+        store.close()
+        persistence.close()
+
+    builder = (
+        Application.builder()
+        .token(os.getenv("TOKEN"))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .persistence(persistence)
+    )
+    # Другой адрес Bot API, например локальная заглушка Telegram для нагрузочных тестов
+    if os.getenv("TELEGRAM_API_URL"):
+        builder = builder.base_url(os.getenv("TELEGRAM_API_URL"))
+    application = builder.build()
+
+    # Периодический сброс изменённых профилей из памяти в хранилище
+    if isinstance(store, CachedUserStore):
+        async def flush_users(_):
+            """
+            Сохраняет накопившиеся изменения профилей
+            """
+            try:
+                store.flush()
+            except Exception as e:
+                print(f"Ошибка сохранения профилей: {e}")
+
+        application.job_queue.run_repeating(
+            flush_users, interval=float(os.getenv("USER_FLUSH_INTERVAL", str(USER_FLUSH_INTERVAL))))
+
+    # Фоновый прогрев кэша для популярных городов
+    application.job_queue.run_repeating(
+        weather_handler.prewarmer.run,
+        interval=float(os.getenv("PREWARM_INTERVAL", str(PREWARM_INTERVAL))),
+        first=10,
+    )
+
+    # Запись состояний диалогов и удаление просроченных
+    application.job_queue.run_repeating(persistence.run, interval=persistence.update_interval)
+
+    # Надзор за процессами браузеров
+    for provider in weather_handler.router.providers:
+        if isinstance(provider, YandexProvider):
+            application.job_queue.run_repeating(
+                provider.supervisor.run,
+                interval=float(os.getenv("CHROME_SUPERVISOR_INTERVAL",
+                                         str(CHROME_SUPERVISOR_INTERVAL))),
+            )
+
+    # Рассылка подписчикам в начале каждой минуты
+    application.job_queue.run_repeating(
+        subscription_handler.run, interval=60, first=60 - datetime.now().second)
 
     # Команда /start
     application.add_handler(CommandHandler("start", settings_handler.start))
 
+    # Команды подписки на ежедневный прогноз
+    application.add_handler(CommandHandler("subscribe", subscription_handler.subscribe))
+    application.add_handler(CommandHandler("unsubscribe", subscription_handler.unsubscribe))
+
     # Обработчик для настроек
     settings_conversation = ConversationHandler(
         entry_points=[CommandHandler("settings", settings_handler.settings)],
@@ -262,23 +3935,63 @@ def main():
             1: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_handler.set_city)],
             2: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_handler.save_city)],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="settings",
+        persistent=True,
+        # Брошенный диалог не занимает память дольше срока хранения состояний
+        conversation_timeout=persistence.ttl,
     )
 
     application.add_handler(settings_conversation)
 
     # Обработчик для погоды
     weather_conversation = ConversationHandler(
-        entry_points=[CommandHandler("weather", weather_handler.weather)],
+        entry_points=[CommandHandler("weather", weather_handler.weather, block=False)],
         states={
-            1: [MessageHandler(filters.TEXT & ~filters.COMMAND, weather_handler.fetch_weather)],
+            # Парсинг идёт в фоне, остальные обновления обрабатываются параллельно
+            1: [MessageHandler(filters.TEXT & ~filters.COMMAND, weather_handler.fetch_weather,
+                               block=False)],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="weather",
+        persistent=True,
+        conversation_timeout=persistence.ttl,
     )
 
     application.add_handler(weather_conversation)
+    startup_mark("настройка")
+    return application
+
 
-    application.run_polling()
+def main():
+    """
+    Основная функция
+    """
+    startup_mark("импорт")
+    load_dotenv()
+    mode = os.getenv("BOT_MODE", BOT_MODE)
+    if mode in ("cluster", "ingress", "webhook") and not os.getenv("WEBHOOK_SECRET"):
+        # Проверка до запуска процессов и приложения
+        raise ValueError(f"Для режима {mode} нужен секретный токен WEBHOOK_SECRET")
+    try:
+        if mode == "cluster":
+            run_cluster()
+        elif mode == "ingress":
+            asyncio.run(run_ingress())
+        elif mode == "worker":
+            worker_process(int(os.getenv("WORKER_ID", "0")))
+        elif mode == "webhook":
+            asyncio.run(run_webhook(build_application()))
+        elif mode == "polling":
+            build_application().run_polling()
+        else:
+            raise ValueError(f"Неизвестный режим работы бота: {mode}")
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
-    main()
+    # python ВОТ_v1.2.py --migrate [user_data.json] [users.sqlite3] — перенос данных в SQLite
+    if len(sys.argv) > 1 and sys.argv[1] == "--migrate":
+        print(f"Перенесено пользователей: {migrate_json_to_sqlite(*sys.argv[2:4])}")
+    else:
+        main()